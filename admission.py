@@ -0,0 +1,136 @@
+import asyncio
+import os
+import time
+from collections import deque
+
+from fastapi import Depends, HTTPException
+
+from database import POOL_SIZE, MAX_OVERFLOW, statement_timeout
+from metrics import metrics
+
+# requests of all classes that may run at once in a process; by default as many as the primary's pool has connections
+ADMISSION_SLOTS = int(os.environ.get('ADMISSION_SLOTS', POOL_SIZE + MAX_OVERFLOW))
+# seconds a shed request is told to wait before retrying
+ADMISSION_RETRY_AFTER = int(os.environ.get('ADMISSION_RETRY_AFTER', 1))
+
+# per class: priority (0 is served first), concurrency, queue depth, seconds a request may queue, statement_timeout ms
+WORKLOAD_DEFAULTS = {
+    'booking': (0, ADMISSION_SLOTS, 200, 5, 5000),
+    'search': (1, max(ADMISSION_SLOTS * 3 // 4, 1), 100, 2, 3000),
+    'analytics': (2, 2, 4, 5, 30000),
+}
+
+
+def _setting(name, key, default, kind=int):
+    return kind(os.environ.get(f'ADMISSION_{name.upper()}_{key}', default))
+
+
+class WorkloadClass:
+    def __init__(self, name, priority, concurrency, queue_depth, queue_timeout, statement_timeout_ms):
+        self.name = name
+        self.priority = priority
+        self.concurrency = concurrency
+        self.queue_depth = queue_depth
+        self.queue_timeout = queue_timeout
+        self.statement_timeout_ms = statement_timeout_ms
+        self.running = 0
+        self.waiting = deque()
+        self.admitted = 0
+        self.queue_full = 0
+        self.queue_timeouts = 0
+
+    @classmethod
+    def from_environment(cls, name):
+        priority, concurrency, queue_depth, queue_timeout, timeout_ms = WORKLOAD_DEFAULTS[name]
+        return cls(name, _setting(name, 'PRIORITY', priority), _setting(name, 'CONCURRENCY', concurrency),
+                   _setting(name, 'QUEUE', queue_depth), _setting(name, 'QUEUE_TIMEOUT', queue_timeout, float),
+                   _setting(name, 'STATEMENT_TIMEOUT_MS', timeout_ms))
+
+
+class Admission:
+    # Admission control of a worker process. Every tagged endpoint belongs to a workload class with a concurrency
+    # limit of its own, and all classes together run at most `slots` requests. A request that can't start queues in
+    # its class; a freed slot goes to the first request of the highest-priority class that is below its limit, so
+    # bookings overtake queued analytics. A request is shed with a 503 and Retry-After when its class's queue is full
+    # or it has queued for longer than the class's queue timeout. Runs on the event loop: no locks.
+    def __init__(self, slots, classes):
+        self.slots = slots
+        self.running = 0
+        self.classes = {c.name: c for c in classes}
+        self.by_priority = sorted(classes, key=lambda c: c.priority)
+
+    def dispatch(self):
+        for c in self.by_priority:
+            while c.waiting and c.running < c.concurrency and self.running < self.slots:
+                waiter = c.waiting.popleft()
+                if not waiter.done():
+                    c.running += 1
+                    self.running += 1
+                    waiter.set_result(None)
+
+    def release(self, c):
+        c.running -= 1
+        self.running -= 1
+        self.dispatch()
+
+    def forget(self, c, waiter):
+        # dispatch() may already have dropped the cancelled waiter
+        if waiter in c.waiting:
+            c.waiting.remove(waiter)
+
+    def shed(self, c, reason):
+        metrics.record_rejection(c.name, reason)
+        raise HTTPException(status_code=503, detail=f'too many {c.name} requests, retry later',
+                            headers={'Retry-After': str(ADMISSION_RETRY_AFTER)})
+
+    async def acquire(self, c):
+        start = time.perf_counter()
+        waiter = asyncio.get_running_loop().create_future()
+        c.waiting.append(waiter)
+        self.dispatch()
+        if not waiter.done():
+            if len(c.waiting) > c.queue_depth:
+                c.waiting.remove(waiter)
+                c.queue_full += 1
+                self.shed(c, 'queue_full')
+            try:
+                await asyncio.wait_for(waiter, c.queue_timeout)
+            except asyncio.TimeoutError:
+                self.forget(c, waiter)
+                c.queue_timeouts += 1
+                self.shed(c, 'queue_timeout')
+            except BaseException:
+                # the client went away while its request queued
+                if waiter.done() and not waiter.cancelled():
+                    self.release(c)
+                else:
+                    self.forget(c, waiter)
+                raise
+        c.admitted += 1
+        metrics.observe_admission_wait(c.name, time.perf_counter() - start)
+
+    def stats(self):
+        return {c.name: {'running': c.running, 'queued': len(c.waiting), 'concurrency': c.concurrency,
+                         'queue_depth': c.queue_depth, 'admitted': c.admitted, 'queue_full': c.queue_full,
+                         'queue_timeouts': c.queue_timeouts, 'statement_timeout_ms': c.statement_timeout_ms}
+                for c in self.by_priority}
+
+
+admission = Admission(ADMISSION_SLOTS, [WorkloadClass.from_environment(name) for name in WORKLOAD_DEFAULTS])
+
+
+def workload(name):
+    """The dependency that admits a request of a workload class, e.g. `dependencies=[workload('booking')]`. The
+    statements of an admitted request run with its class's statement_timeout; the slot is given back once the
+    response has been sent."""
+    c = admission.classes[name]
+
+    async def admit():
+        await admission.acquire(c)
+        try:
+            statement_timeout.set(c.statement_timeout_ms)
+            yield
+        finally:
+            admission.release(c)
+
+    return Depends(admit)
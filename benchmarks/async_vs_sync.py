@@ -0,0 +1,88 @@
+"""Compare requests/sec of the sync endpoints against their /async twins.
+
+Start the API first (python main.py), then run for example:
+
+    python benchmarks/async_vs_sync.py --requests 5000 --concurrency 50 200 1000
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import time
+
+import httpx
+
+ENDPOINTS = {
+    'exact_params': ('/get_possible_travels_for_passenger_with_exact_params',
+                     {'source_city': 1, 'destination_city': 2, 'travel_date': '2024-02-02T00:00:00'}),
+    'possible_travels': ('/get_possible_travels_for_passenger', {}),
+    'filter_travels': ('/filter_travels', {'vehicle_type': 'bus'}),
+}
+
+
+async def run_level(base_url, path, params, concurrency, total):
+    latencies = []
+    errors = 0
+    remaining = total
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=60) as client:
+        async def worker():
+            nonlocal remaining, errors
+            while remaining > 0:
+                remaining -= 1
+                start = time.perf_counter()
+                try:
+                    r = await client.get(path, params=params)
+                    if r.status_code != 200:
+                        errors += 1
+                except httpx.HTTPError:
+                    errors += 1
+                latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        'concurrency': concurrency,
+        'requests': total,
+        'errors': errors,
+        'seconds': round(elapsed, 3),
+        'rps': round(total / elapsed, 1),
+        'p50_ms': round(statistics.median(latencies) * 1000, 2),
+        'p99_ms': round(latencies[int(len(latencies) * 0.99) - 1] * 1000, 2),
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--base-url', default='http://127.0.0.1:8080')
+    parser.add_argument('--email-phone', default='p@p.com')
+    parser.add_argument('--password', default='1234')
+    parser.add_argument('--endpoint', choices=ENDPOINTS, default='exact_params')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[50, 200, 1000])
+    parser.add_argument('--requests', type=int, default=5000, help='requests per concurrency level and mode')
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args()
+
+    async with httpx.AsyncClient(base_url=args.base_url) as client:
+        r = await client.get('/token', params={'email_phone': args.email_phone, 'password': args.password})
+        token = r.json()['token']
+
+    path, params = ENDPOINTS[args.endpoint]
+    params = dict(params, token=token)
+    results = []
+    for concurrency in args.concurrency:
+        for mode, prefix in (('sync', ''), ('async', '/async')):
+            result = await run_level(args.base_url, prefix + path, params, concurrency, args.requests)
+            result['mode'] = mode
+            results.append(result)
+            if not args.json:
+                print(f"{mode:>5} c={concurrency:<5} {result['rps']:>9} req/s  p50 {result['p50_ms']:>8} ms  "
+                      f"p99 {result['p99_ms']:>8} ms  errors {result['errors']}")
+    if args.json:
+        print(json.dumps({'endpoint': args.endpoint, 'results': results}, indent=2))
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
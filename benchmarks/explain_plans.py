@@ -0,0 +1,185 @@
+"""Run every endpoint's SQL under EXPLAIN and fail if a hot query sequentially scans a large table.
+
+Each endpoint is called through the app with its statements rewritten to EXPLAIN (FORMAT JSON), so nothing is
+executed or modified. By default the planner runs with enable_seqscan off: a Seq Scan in the plan then means no
+index can serve the predicate at all, which holds regardless of how much data the database has. On a database
+seeded to production scale (see benchmarks/pricing.py --load), --real-planner checks the plans the planner
+would really choose.
+
+    python benchmarks/explain_plans.py [--real-planner] [--verbose]
+"""
+import argparse
+import os
+import re
+import sys
+import time
+from datetime import datetime
+
+from sqlalchemy import event
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import main  # noqa: E402
+from database import get_engine  # noqa: E402
+from pagination import encode_cursor  # noqa: E402
+from reference_data import discounts  # noqa: E402
+from sessions import session_cache  # noqa: E402
+
+HOT_TABLES = {'tickets', 'travels', 'users', 'messages', 'support_tickets', 'travel_changes'}
+
+# endpoints that read a whole table by design
+ALLOWED_SEQ_SCANS = {
+    '/filter_travels': {'travels'},
+    '/bestselling_travels': {'tickets'},
+    '/top_5_customers': {'tickets', 'travels'},
+    '/reconcile_seat_counters': {'tickets', 'travels'},
+}
+
+SESSIONS = {
+    'passenger': {'id': 2, 'user_role': 'passenger', 'agency_id': None},
+    'manager': {'id': 3, 'user_role': 'manager', 'agency_id': 1},
+    'admin': {'id': 1, 'user_role': 'admin', 'agency_id': None},
+}
+
+CALLS = [
+    ('/login', None, {'email_phone': 'p@p.com', 'password': '1234'}),
+    ('/token', None, {'email_phone': 'p@p.com', 'password': '1234'}),
+    ('/register', None, {'email': 'x@x.com', 'phone_number': '09130000000', 'first_name': 'x', 'last_name': 'x',
+                         'password': 'x', 'role': 'passenger'}),
+    ('/send_otp', None, {'email_phone': 'p@p.com'}),
+    ('/otp', None, {'email_phone': 'p@p.com', 'code': '12345'}),
+    ('/create_support_ticket', 'passenger', {'title': 'x'}),
+    ('/get_support_tickets', 'passenger', {}),
+    ('/get_support_tickets', 'admin', {}),
+    ('/edit_support_ticket', 'passenger', {'ticket_id': 1, 'title': 'x'}),
+    ('/delete_support_ticket', 'passenger', {'ticket_id': 1}),
+    ('/get_messages', 'passenger', {'ticket_id': 1}),
+    ('/send_messages', 'passenger', {'ticket_id': 1, 'message': 'x'}),
+    ('/add_agency', 'admin', {'name': 'x'}),
+    ('/update_agency', 'admin', {'agency_id': 1, 'name': 'x'}),
+    ('/get_agency', 'admin', {}),
+    ('/delete_agency', 'admin', {'agency_id': 1}),
+    ('/deactivate_user', 'admin', {'user_id': 2}),
+    ('/change_user_role', 'admin', {'user_id': 2, 'role': 'passenger'}),
+    ('/add_city', 'manager', {'country': 'x', 'city': 'x'}),
+    ('/get_cities', 'manager', {}),
+    ('/search_cities', None, {'q': 'teh'}),
+    ('/update_city', 'manager', {'city_id': 1, 'country': 'x', 'city': 'x'}),
+    ('/delete_city', 'manager', {'city_id': 1}),
+    ('/add_discount', 'admin', {'discount_code': 'x', 'percent': 10, 'max_limit': 10}),
+    ('/update_discount', 'admin', {'discount_code': 'x', 'percent': 10, 'max_limit': 10}),
+    ('/get_discounts', 'admin', {}),
+    ('/delete_discounts', 'admin', {'discount_code': 'x'}),
+    ('/get_travels', 'manager', {}),
+    ('/add_travel', 'manager', {'travel_date': '2030-01-01T10:00:00', 'vehicle_type': 'bus', 'price': 1,
+                                'number_of_seats': 1, 'source_city': 1, 'destination_city': 2}),
+    ('/edit_travel', 'manager', {'travel_id': 1, 'travel_date': '2030-01-01T10:00:00', 'vehicle_type': 'bus',
+                                 'price': 1, 'number_of_seats': 1, 'source_city': 1, 'destination_city': 2}),
+    ('/delete_travel', 'manager', {'travel_id': 1}),
+    ('/get_possible_travels_for_passenger', 'passenger', {}),
+    ('/get_possible_travels_for_passenger', 'passenger',
+     {'cursor': encode_cursor('travel_date:asc', datetime(2030, 1, 1), 1)}),
+    ('/get_possible_travels_for_passenger_with_exact_params', 'passenger',
+     {'source_city': 1, 'destination_city': 2, 'travel_date': '2030-01-01T00:00:00'}),
+    ('/travel_changes', 'passenger', {'since': 1000}),
+    ('/travel_changes/snapshot', 'passenger', {}),
+    ('/travel_changes/snapshot', 'passenger', {'cursor': encode_cursor('travel_date:asc', datetime(2030, 1, 1), 1)}),
+    ('/get_itineraries', 'passenger', {'source_city': 1, 'destination_city': 2, 'travel_date': '2030-01-01T00:00:00'}),
+    ('/reserve_ticket', 'passenger', {'travel_id': 1}),
+    ('/set_discount', 'passenger', {'ticket_id': 1, 'discount_code': 'x'}),
+    ('/pay_ticket', 'passenger', {'ticket_id': 1}),
+    ('/checkout', 'passenger', {'travel_id': 1, 'seats': 2, 'discount_code': 'x'}),
+    ('/rate_ticket', 'passenger', {'ticket_id': 1, 'rate': 5}),
+    ('/cancel_ticket', 'passenger', {'ticket_id': 1}),
+    ('/top_5_customers', 'manager', {'month': 6}),
+    ('/filter_tickets', 'passenger', {'price_min': 1, 'status': 'paid', 'vehicle_type': 'bus',
+                                      'date_min': '2024-01-01T00:00:00'}),
+    ('/filter_tickets', 'passenger', {'cursor': encode_cursor('id:asc', 1, 1)}),
+    ('/filter_tickets', 'passenger', {'source_city': 'teh', 'destination_city': 'shi'}),
+    ('/filter_travels', None, {'price_min': 1, 'vehicle_type': 'bus'}),
+    ('/filter_travels', None, {'source_city': 'teh', 'destination_city': 'shi'}),
+    ('/bestselling_travels', 'manager', {}),
+    ('/highest_rating', 'manager', {}),
+    ('/get_highest_income', 'manager', {'year': 2024}),
+    ('/most_popular_destination', 'manager', {}),
+    ('/reconcile_seat_counters', 'admin', {}),
+]
+
+
+def seq_scans(plan):
+    found = []
+    if plan.get('Node Type') == 'Seq Scan':
+        # a month's partition of travels or tickets counts as the table
+        found.append(re.sub(r'_y\d{4}m\d{2}$', '', plan.get('Relation Name', '')))
+    for child in plan.get('Plans', []):
+        found.extend(seq_scans(child))
+    return found
+
+
+def run():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--real-planner', action='store_true', help='keep enable_seqscan on')
+    parser.add_argument('--verbose', action='store_true', help='print every statement and its scans')
+    args = parser.parse_args()
+
+    from fastapi.testclient import TestClient
+
+    captured = []
+    errors = []
+    engine = get_engine()
+
+    @event.listens_for(engine, 'connect')
+    def configure(dbapi_connection, connection_record):
+        if not args.real_planner:
+            dbapi_connection.autocommit = True
+            dbapi_connection.cursor().execute('SET enable_seqscan = off')
+            dbapi_connection.autocommit = False
+
+    @event.listens_for(engine, 'before_cursor_execute', retval=True)
+    def explain(conn, cursor, statement, parameters, context, executemany):
+        return 'EXPLAIN (FORMAT JSON) ' + statement, parameters
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def collect(conn, cursor, statement, parameters, context, executemany):
+        # consuming the plan leaves the endpoint an empty result, so flows stop after their first read
+        captured.append((statement[len('EXPLAIN (FORMAT JSON) '):], cursor.fetchall()[0][0][0]['Plan']))
+
+    @event.listens_for(engine, 'handle_error')
+    def failed(context):
+        errors.append(str(context.original_exception).splitlines()[0])
+
+    failures = 0
+    client = TestClient(main.app, raise_server_exceptions=False)
+    for path, role, params in CALLS:
+        # re-seeded every call: deactivate_user and change_user_role drop the cached sessions
+        for name, session in SESSIONS.items():
+            session_cache.put('explain-' + name, dict(session), time.time() + 3600)
+        # the code the discount flows use, so that they get past the cache to their own SQL
+        discounts.build([{'code': 'x', 'percent': 10, 'maximum_limit': 10}], time.monotonic())
+        captured.clear()
+        errors.clear()
+        if role:
+            params = dict(params, token='explain-' + role)
+        r = client.get(path, params=params)
+        if r.status_code != 200:
+            print(f'ERROR {path}: HTTP {r.status_code}')
+            failures += 1
+            continue
+        for error in errors:
+            print(f'ERROR {path}: {error}')
+            failures += 1
+        allowed = ALLOWED_SEQ_SCANS.get(path, set())
+        for statement, plan in captured:
+            bad = sorted({t for t in seq_scans(plan) if t in HOT_TABLES and t not in allowed})
+            if bad:
+                failures += 1
+                print(f"FAIL  {path}: seq scan on {', '.join(bad)}\n      {' '.join(statement.split())}")
+            elif args.verbose:
+                print(f"ok    {path}: {' '.join(statement.split())[:100]}")
+        if not captured and not errors:
+            print(f'note  {path}: no SQL captured')
+    print(f'{failures} failure(s)')
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(run())
@@ -0,0 +1,134 @@
+"""Check the itinerary search against brute force and time it.
+
+Needs no database. First runs the hand-built cases that earlier versions of the search got wrong, then builds
+--graphs random travel graphs of --cities cities and --travels travels each and compares the itineraries
+ItineraryGraph.search returns with every itinerary enumerated by brute force, for both sorts and several limits.
+Prints the mismatches and the mean time of a search, and exits non-zero on any mismatch:
+
+    python benchmarks/itinerary_search.py --graphs 200 --cities 8 --travels 120
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from itineraries import ItineraryGraph, ItinerarySort, ITINERARY_MAX_HOURS  # noqa: E402
+
+DAY = (datetime.now() + timedelta(days=30)).date()
+MIDNIGHT = datetime.combine(DAY, datetime.min.time())
+
+
+def travel(travel_id, source, destination, departs, arrives, price, seats=10):
+    return {'id': travel_id, 'source_city': source, 'destination_city': destination,
+            'travel_date': MIDNIGHT + timedelta(hours=departs), 'arrival_date': MIDNIGHT + timedelta(hours=arrives),
+            'vehicle_type': 'bus', 'price': price, 'remaining_seats': seats, 'agency_name': 'x'}
+
+
+def graph(rows):
+    g = ItineraryGraph(3600)
+    g.build(rows, time.monotonic())
+    return g
+
+
+def sort_key(sort, itinerary):
+    if sort == ItinerarySort.CHEAPEST:
+        return itinerary['price'], itinerary['arrival']
+    return itinerary['arrival'], itinerary['price']
+
+
+def brute_force(rows, source, destination, sort, max_legs, min_connection, seats):
+    # every itinerary the search may return, best first
+    legs = [leg for city_legs in graph(rows).departures.values() for leg in city_legs]
+    max_trip, connection = timedelta(hours=ITINERARY_MAX_HOURS), timedelta(minutes=min_connection)
+    found = []
+
+    def extend(path):
+        last = path[-1]
+        if last.destination == destination:
+            found.append({'arrival': last.arrival, 'price': sum(leg.price for leg in path)})
+            return
+        if len(path) >= max_legs:
+            return
+        visited = {leg.source for leg in path}
+        deadline = path[0].departure + max_trip
+        for leg in legs:
+            if leg.source == last.destination and leg.departure >= last.arrival + connection and \
+                    leg.departure < deadline and leg.arrival <= deadline and leg.destination not in visited and \
+                    leg.remaining_seats >= seats:
+                extend(path + (leg,))
+
+    for leg in legs:
+        if leg.source == source and MIDNIGHT <= leg.departure < MIDNIGHT + timedelta(days=1) and \
+                leg.remaining_seats >= seats and leg.arrival - leg.departure <= max_trip:
+            extend((leg,))
+    return sorted((sort_key(sort, i) for i in found))
+
+
+def check(rows, source, destination, sort, limit, max_legs=3, min_connection=60, seats=1):
+    g = graph(rows)
+    start = time.perf_counter()
+    got = [sort_key(sort, i) for i in g.search(source, destination, DAY, sort, max_legs, min_connection, seats, limit)]
+    elapsed = time.perf_counter() - start
+    expected = brute_force(rows, source, destination, sort, max_legs, min_connection, seats)[:limit]
+    return got == expected, got, expected, elapsed
+
+
+def known_cases():
+    # six cheap travels 1 -> 2 arrive too late for the only 2 -> 3 travel; the dear one arrives in time
+    late_arrivals = [travel(i, 1, 2, 8, 20, 1) for i in range(1, 7)] + [travel(7, 1, 2, 1, 3, 100),
+                                                                         travel(8, 2, 3, 6, 9, 1)]
+    return [('late cheap arrivals', late_arrivals, 1, 3)]
+
+
+def random_rows(rng, cities, travels):
+    rows = []
+    for travel_id in range(1, travels + 1):
+        source, destination = rng.sample(range(1, cities + 1), 2)
+        departs = rng.uniform(0, 60)
+        rows.append(travel(travel_id, source, destination, departs, departs + rng.uniform(0.5, 12),
+                           rng.randint(1, 20), rng.randint(0, 3)))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--graphs', type=int, default=200)
+    parser.add_argument('--cities', type=int, default=8)
+    parser.add_argument('--travels', type=int, default=120)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    failures = 0
+    for name, rows, source, destination in known_cases():
+        for sort in ItinerarySort:
+            for limit in (1, 5):
+                ok, got, expected, _ = check(rows, source, destination, sort, limit)
+                if not ok:
+                    failures += 1
+                    print(f'FAIL  {name}, {sort.value}, limit {limit}: got {got}, expected {expected}')
+
+    rng = random.Random(args.seed)
+    searches, elapsed = 0, 0.0
+    for n in range(args.graphs):
+        rows = random_rows(rng, args.cities, args.travels)
+        source, destination = rng.sample(range(1, args.cities + 1), 2)
+        for sort in ItinerarySort:
+            for limit in (1, 3, 10):
+                seats = rng.randint(1, 2)
+                ok, got, expected, took = check(rows, source, destination, sort, limit, seats=seats)
+                elapsed += took
+                searches += 1
+                if not ok:
+                    failures += 1
+                    print(f'FAIL  graph {n}, {sort.value}, limit {limit}, seats {seats}: got {len(got)}, expected '
+                          f'{len(expected)}')
+    print(f'{searches} random searches, {elapsed / searches * 1000:.2f} ms per search, '
+          f'{failures} failure(s)')
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,158 @@
+"""Sequence and compact the travel change feed (migrations/010_travel_change_feed.sql).
+
+    python change_feed.py                      number the pending changes and compact the ones older than
+                                               CHANGE_FEED_RETENTION_DAYS
+    python change_feed.py --retention-days 30  ... older than 30 days
+
+The API processes number pending changes in the background every CHANGE_FEED_SEQUENCE_INTERVAL seconds; run this
+daily, e.g. from cron, to compact.
+"""
+import argparse
+import asyncio
+import os
+import sys
+import threading
+import time
+
+from fastapi import HTTPException
+from sqlalchemy import create_engine, text
+
+from database import DATABASE_URL, get_engine, record_failure
+
+CHANGE_FEED_RETENTION_DAYS = int(os.environ.get('CHANGE_FEED_RETENTION_DAYS', 7))
+# pending changes numbered per transaction
+CHANGE_FEED_SEQUENCE_BATCH = int(os.environ.get('CHANGE_FEED_SEQUENCE_BATCH', 10000))
+# seconds between two sequencing runs of an API process; 0 leaves sequencing to change_feed.py
+CHANGE_FEED_SEQUENCE_INTERVAL = float(os.environ.get('CHANGE_FEED_SEQUENCE_INTERVAL', 1))
+
+SEQUENCE_CHANGES_QUERY = "SELECT sequence_travel_changes(:batch)"
+COMPACT_CHANGES_QUERY = "SELECT compact_travel_changes(make_interval(days => :days))"
+FEED_COLUMNS = "t.id, t.travel_date, t.arrival_date, t.vehicle_type, t.price, t.number_of_seats, t.remaining_seats, " \
+               "t.source_city, t.destination_city, t.agency_id"
+# The changes after :since, the latest one per travel, with the travel's current row or deleted = true. The travel
+# is looked up in the partition of its date at the change, and only in the others if it has moved since. The
+# compaction horizon is read in the same statement as the changes, so a concurrent compaction can't slip between.
+CHANGES_QUERY = \
+    "WITH page AS (SELECT seq, travel_id, travel_date FROM travel_changes WHERE seq > :since ORDER BY seq " \
+    "LIMIT :n + 1), " \
+    "latest AS (SELECT DISTINCT ON (travel_id) seq, travel_id, travel_date FROM " \
+    "(SELECT * FROM page ORDER BY seq LIMIT :n) p ORDER BY travel_id, seq DESC) " \
+    "SELECT f.compacted_through, (SELECT count(*) FROM page) > :n AS more, l.seq, l.travel_id, " \
+    "t.id IS NULL AS deleted, " + FEED_COLUMNS.replace('t.id, ', '') + " " \
+    "FROM change_feed f LEFT JOIN (latest l LEFT JOIN LATERAL (" \
+    "SELECT " + FEED_COLUMNS + " FROM travels t WHERE t.id = l.travel_id AND t.travel_date = l.travel_date " \
+    "UNION ALL " \
+    "SELECT " + FEED_COLUMNS + " FROM travels t WHERE t.id = l.travel_id AND t.travel_date != l.travel_date " \
+    "LIMIT 1) t ON true) ON true ORDER BY l.seq"
+# The sequence a snapshot starts from, read on the primary before its first page: every change numbered up to it is
+# in the snapshot, and any that isn't gets a larger number.
+SNAPSHOT_SEQUENCE_QUERY = \
+    "SELECT greatest((SELECT max(seq) FROM travel_changes), (SELECT compacted_through FROM change_feed)) AS sequence"
+SNAPSHOT_QUERY = "SELECT " + FEED_COLUMNS + " FROM travels t WHERE t.travel_date > now()"
+
+
+def changes_page(rows, since):
+    """The response of /travel_changes from the rows of CHANGES_QUERY."""
+    if not rows:
+        return rows
+    if since < rows[0]['compacted_through']:
+        raise HTTPException(status_code=410, detail='changes after this sequence were compacted; bootstrap again '
+                                                    'from /travel_changes/snapshot')
+    more, changes = rows[0]['more'], []
+    for row in rows:
+        if row['seq'] is None:
+            break
+        change = {'seq': row.pop('seq'), 'id': row.pop('travel_id'), 'deleted': row.pop('deleted')}
+        if not change['deleted']:
+            del row['compacted_through'], row['more']
+            change.update(row)
+        changes.append(change)
+    return {'changes': changes, 'next': changes[-1]['seq'] if changes else since, 'more': more}
+
+
+def sequence_changes(conn):
+    """Number the pending changes in transactions of CHANGE_FEED_SEQUENCE_BATCH until none are left, or until another
+    run holds the lock; returns how many were numbered."""
+    sequenced = 0
+    while True:
+        moved = conn.execute(text(SEQUENCE_CHANGES_QUERY), {'batch': CHANGE_FEED_SEQUENCE_BATCH}).scalar()
+        conn.commit()
+        sequenced += moved
+        if moved < CHANGE_FEED_SEQUENCE_BATCH:
+            return sequenced
+
+
+class ChangeSequencer:
+    # Numbers the recorded travel changes every interval seconds in each API process, so that /travel_changes only
+    # reads and a poll costs the same whether or not anything changed. The processes take turns: a run that finds
+    # another one under way skips its turn. A failed run is logged and retried at the next interval; meanwhile the
+    # feed only lags behind.
+    def __init__(self, interval):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.task = None
+        self.runs = 0
+        self.sequenced = 0
+        self.failures = 0
+        self.last_run = None
+
+    def start(self):
+        # a new event loop (a test client, a reloaded worker) needs its own task
+        if self.interval > 0 and (self.task is None or self.task.done() or
+                                  self.task.get_loop() is not asyncio.get_running_loop()):
+            self.task = asyncio.get_running_loop().create_task(self.run_forever())
+
+    async def stop(self):
+        if self.task is not None and not self.task.done():
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+
+    async def run_forever(self):
+        while True:
+            await asyncio.to_thread(self.run)
+            await asyncio.sleep(self.interval)
+
+    def run(self):
+        try:
+            with get_engine().connect() as conn:
+                sequenced = sequence_changes(conn)
+        except Exception as e:
+            record_failure('sequence_travel_changes', e)
+            with self.lock:
+                self.failures += 1
+            return
+        with self.lock:
+            self.runs += 1
+            self.sequenced += sequenced
+            self.last_run = time.monotonic()
+
+    def stats(self):
+        with self.lock:
+            return {'interval': self.interval, 'runs': self.runs, 'sequenced': self.sequenced,
+                    'failures': self.failures,
+                    'age': round(time.monotonic() - self.last_run, 1) if self.last_run is not None else None}
+
+
+change_sequencer = ChangeSequencer(CHANGE_FEED_SEQUENCE_INTERVAL)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database-url', default=DATABASE_URL)
+    parser.add_argument('--retention-days', type=int, default=CHANGE_FEED_RETENTION_DAYS)
+    args = parser.parse_args()
+
+    engine = create_engine(args.database_url)
+    with engine.connect() as conn:
+        print(f'numbered {sequence_changes(conn)} change(s)')
+        dropped = conn.execute(text(COMPACT_CHANGES_QUERY), {'days': args.retention_days}).scalar()
+        conn.commit()
+        print(f'compacted {dropped} change(s) older than {args.retention_days} days')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,118 @@
+import heapq
+import os
+import threading
+import time
+from bisect import bisect_left
+
+CITY_INDEX_TTL = int(os.environ.get('CITY_INDEX_TTL', 300))
+CITY_SEARCH_LIMIT = int(os.environ.get('CITY_SEARCH_LIMIT', 10))
+
+CITIES_QUERY = "SELECT id, country, city FROM cities ORDER BY id"
+
+
+def _grams(s):
+    # every substring of up to three characters; a longer query is found through the trigrams it contains
+    return {s[i:i + n] for n in (1, 2, 3) for i in range(len(s) - n + 1)}
+
+
+class _Index:
+    def __init__(self, rows):
+        self.cities = {r['id']: r for r in rows}
+        # (lowercased name, id) sorted for prefix lookups, one entry per city name and one per country name
+        self.names = sorted([(r['city'].casefold(), r['id']) for r in rows] +
+                            [(r['country'].casefold(), r['id']) for r in rows])
+        self.city_grams = {}
+        self.any_grams = {}
+        for r in rows:
+            city, country = r['city'].casefold(), r['country'].casefold()
+            for gram in _grams(city):
+                self.city_grams.setdefault(gram, set()).add(r['id'])
+                self.any_grams.setdefault(gram, set()).add(r['id'])
+            for gram in _grams(country):
+                self.any_grams.setdefault(gram, set()).add(r['id'])
+
+    @staticmethod
+    def _candidates(postings, q):
+        grams = [q] if len(q) <= 3 else [q[i:i + 3] for i in range(len(q) - 2)]
+        sets = sorted((postings.get(g, ()) for g in grams), key=len)
+        return set(sets[0]).intersection(*sets[1:]) if sets else set()
+
+    def city_ids(self, q):
+        # up to three characters the postings are exact; longer queries only matched each trigram somewhere in the
+        # name, so those candidates are checked
+        ids = self._candidates(self.city_grams, q)
+        if len(q) > 3:
+            ids = [i for i in ids if q in self.cities[i]['city'].casefold()]
+        return sorted(ids)
+
+    def search(self, q, limit):
+        found = []
+        seen = set()
+        # prefixes of a city or country name first, in alphabetical order
+        i = bisect_left(self.names, (q,))
+        while i < len(self.names) and len(found) < limit and self.names[i][0].startswith(q):
+            if self.names[i][1] not in seen:
+                seen.add(self.names[i][1])
+                found.append(self.cities[self.names[i][1]])
+            i += 1
+        if len(found) < limit:
+            rest = (self.cities[c] for c in self._candidates(self.any_grams, q) if c not in seen)
+            if len(q) > 3:
+                rest = (r for r in rest if q in r['city'].casefold() or q in r['country'].casefold())
+            found += heapq.nsmallest(limit - len(found), rest, key=lambda r: (r['city'].casefold(), r['id']))
+        return found
+
+
+class CityIndex:
+    # An n-gram index of the cities table held in memory, for autocomplete, for resolving the city name filters to
+    # ids and city ids to names. It is one of the reference tables of reference_data.py: changes made through any
+    # process are announced over NOTIFY and reloaded, and it is rebuilt by the next request that needs it after
+    # add_city, update_city, delete_city or CITY_INDEX_TTL seconds.
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.index = None
+        self.built = -1
+        self.invalidated = -1
+        self.builds = 0
+
+    def stale(self):
+        return self.index is None or self.invalidated >= self.built or self.built + self.ttl < time.monotonic()
+
+    def build(self, rows, started):
+        # rows is the result of CITIES_QUERY read after started; False (a failed read) keeps the old index
+        if rows is False:
+            return
+        index = _Index(rows)
+        with self.lock:
+            if started > self.built:
+                self.index, self.built = index, started
+                self.builds += 1
+
+    def invalidate(self):
+        with self.lock:
+            self.invalidated = time.monotonic()
+
+    def city_ids(self, name):
+        return self.index.city_ids(name.casefold()) if self.index else []
+
+    def name(self, city_id):
+        r = self.index.cities.get(city_id) if self.index else None
+        return r['city'] if r else None
+
+    def rows(self):
+        return list(self.index.cities.values()) if self.index else []
+
+    def search(self, q, limit):
+        q = q.strip().casefold()
+        if not q or not self.index:
+            return []
+        return self.index.search(q, limit)
+
+    def stats(self):
+        with self.lock:
+            return {'cities': len(self.index.cities) if self.index else 0, 'builds': self.builds,
+                    'age': round(time.monotonic() - self.built, 1) if self.index else None, 'ttl': self.ttl}
+
+
+city_index = CityIndex(CITY_INDEX_TTL)
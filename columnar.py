@@ -0,0 +1,106 @@
+import json
+from datetime import date, time, timedelta
+from decimal import Decimal
+from typing import Union
+
+from fastapi import Header
+from starlette.responses import Response
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+COLUMNAR_MEDIA_TYPE = 'application/vnd.columnar+json'
+
+
+class Columns:
+    # A query result as the cursor returned it: the column names once and the row tuples, with no dict per row.
+    # It is serialized column by column, {"columns": [names], "values": [[the first column's values], ...]}, so
+    # every name is sent once rather than once per row. convert() and drop() take effect when it is serialized.
+    def __init__(self, keys, rows):
+        self.keys = list(keys)
+        self.rows = rows
+        self.converters = {}
+        self.dropped = set()
+
+    def __len__(self):
+        return len(self.rows)
+
+    def value(self, row, name):
+        return self.rows[row][self.keys.index(name)]
+
+    def truncate(self, n):
+        self.rows = self.rows[:n]
+
+    def convert(self, name, f):
+        self.converters[name] = f
+
+    def drop(self, name):
+        self.dropped.add(name)
+
+    def as_dict(self):
+        values = zip(*self.rows) if self.rows else [()] * len(self.keys)
+        names, arrays = [], []
+        for name, column in zip(self.keys, values):
+            if name in self.dropped:
+                continue
+            f = self.converters.get(name)
+            names.append(name)
+            arrays.append(list(map(f, column)) if f else column)
+        return {'columns': names, 'values': arrays}
+
+
+def _default(value):
+    # the types orjson leaves to us, encoded the way FastAPI's JSON responses encode them
+    if isinstance(value, Columns):
+        return value.as_dict()
+    if isinstance(value, Decimal):
+        return int(value) if value.as_tuple().exponent >= 0 else float(value)
+    if isinstance(value, (date, time)):
+        return value.isoformat()
+    if isinstance(value, timedelta):
+        return value.total_seconds()
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+def dumps(content):
+    if orjson is not None:
+        return orjson.dumps(content, default=_default)
+    return json.dumps(content, default=_default, separators=(',', ':')).encode()
+
+
+class ColumnarResponse(Response):
+    media_type = COLUMNAR_MEDIA_TYPE
+
+    def __init__(self, content, **kwargs):
+        super().__init__(content, headers={'Vary': 'Accept'}, **kwargs)
+
+    def render(self, content):
+        return dumps(content)
+
+
+def _accepts(accept, media_type):
+    for part in accept.split(','):
+        kind, *params = [p.strip() for p in part.split(';')]
+        if kind == media_type:
+            return 'q=0' not in params and 'q=0.0' not in params
+    return False
+
+
+class ListFormat:
+    """How a list endpoint reads and returns its rows: as a list of dicts by default, or as Columns when the client
+    sends `Accept: application/vnd.columnar+json`."""
+
+    def __init__(self, columnar):
+        self.columnar = columnar
+
+    def response(self, content):
+        # False and "forbidden" stay plain JSON
+        if self.columnar and isinstance(content, (dict, Columns)):
+            return ColumnarResponse(content)
+        return content
+
+
+def list_format(accept: Union[str, None] = Header(None)):
+    return ListFormat(accept is not None and _accepts(accept, COLUMNAR_MEDIA_TYPE))
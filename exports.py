@@ -0,0 +1,56 @@
+import csv
+import io
+import json
+import os
+from datetime import date
+from decimal import Decimal
+from enum import Enum
+
+from starlette.responses import StreamingResponse
+
+from database import stream_query
+
+EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE', 5000))
+
+
+class ExportFormat(str, Enum):
+    NDJSON = 'ndjson'
+    CSV = 'csv'
+
+
+MEDIA_TYPES = {ExportFormat.NDJSON: 'application/x-ndjson', ExportFormat.CSV: 'text/csv'}
+
+
+def _json_default(value):
+    if isinstance(value, date):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return float(value)
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+def _ndjson(batches):
+    keys = next(batches)
+    for rows in batches:
+        yield ''.join(json.dumps(dict(zip(keys, row)), default=_json_default) + '\n' for row in rows)
+
+
+def _csv(batches):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(next(batches))
+    yield buffer.getvalue()
+    for rows in batches:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(rows)
+        yield buffer.getvalue()
+
+
+def export_response(db, export: ExportFormat, name, query, **args):
+    # the stream reads through its own connection; don't keep the one used for authorization for the whole download
+    db.close()
+    batches = stream_query(query, EXPORT_BATCH_SIZE, db.read, **args)
+    body = _ndjson(batches) if export == ExportFormat.NDJSON else _csv(batches)
+    return StreamingResponse(body, media_type=MEDIA_TYPES[export],
+                             headers={'Content-Disposition': f'attachment; filename="{name}.{export.value}"'})
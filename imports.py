@@ -0,0 +1,206 @@
+import codecs
+import csv
+import json
+import os
+import time
+from enum import Enum
+
+from fastapi import HTTPException
+from sqlalchemy import text
+
+from database import record_failure
+from partitions import month_partitions, ENSURE_PARTITIONS_QUERY
+
+IMPORT_MAX_ERRORS = int(os.environ.get('IMPORT_MAX_ERRORS', 1000))
+
+TRAVEL_COLUMNS = ['travel_date', 'vehicle_type', 'price', 'number_of_seats', 'source_city', 'destination_city']
+
+
+class ImportFormat(str, Enum):
+    NDJSON = 'ndjson'
+    CSV = 'csv'
+
+
+# Rows are copied in as text so that a bad value becomes an error for its row instead of aborting the COPY.
+CREATE_STAGING_QUERY = \
+    "CREATE TEMP TABLE travel_import (row int, travel_date text, vehicle_type text, price text, " \
+    "number_of_seats text, source_city text, destination_city text) ON COMMIT DROP"
+CREATE_CHECKED_QUERY = \
+    "CREATE TEMP TABLE travel_import_checked (row int, travel_date timestamp, vehicle_type text, price int, " \
+    "number_of_seats int, source_city int, destination_city int, existing boolean, errors text[]) ON COMMIT DROP"
+# A travel is identified by agency, route, departure and vehicle: importing a timetable again updates the price and
+# seats of the travels it already created instead of adding them twice.
+CHECK_IMPORT_QUERY = \
+    "INSERT INTO travel_import_checked " \
+    "WITH typed AS (SELECT row," \
+    " CASE WHEN pg_input_is_valid(travel_date, 'timestamp') THEN travel_date::timestamp END AS travel_date," \
+    " vehicle_type," \
+    " CASE WHEN pg_input_is_valid(price, 'int') THEN price::int END AS price," \
+    " CASE WHEN pg_input_is_valid(number_of_seats, 'int') THEN number_of_seats::int END AS number_of_seats," \
+    " CASE WHEN pg_input_is_valid(source_city, 'int') THEN source_city::int END AS source_city," \
+    " CASE WHEN pg_input_is_valid(destination_city, 'int') THEN destination_city::int END AS destination_city" \
+    " FROM travel_import) " \
+    "SELECT s.row, s.travel_date, s.vehicle_type, s.price, s.number_of_seats, s.source_city, s.destination_city," \
+    " existing.paid_count IS NOT NULL," \
+    " array_remove(ARRAY[" \
+    "  CASE WHEN s.travel_date IS NULL THEN 'travel_date must be a timestamp' END," \
+    "  CASE WHEN am.month IS NOT NULL THEN 'travel_date is in an archived month' END," \
+    "  CASE WHEN s.vehicle_type IS NULL OR s.vehicle_type NOT IN ('bus', 'train', 'airplane')" \
+    "   THEN 'vehicle_type must be bus, train or airplane' END," \
+    "  CASE WHEN s.price IS NULL OR s.price < 0 THEN 'price must be a non-negative integer' END," \
+    "  CASE WHEN s.number_of_seats IS NULL OR s.number_of_seats < 0" \
+    "   THEN 'number_of_seats must be a non-negative integer' END," \
+    "  CASE WHEN sc.id IS NULL THEN 'source_city is not a city id' END," \
+    "  CASE WHEN dc.id IS NULL THEN 'destination_city is not a city id' END," \
+    "  CASE WHEN s.source_city = s.destination_city THEN 'source_city and destination_city must differ' END," \
+    "  CASE WHEN s.travel_date IS NOT NULL AND min(s.row) OVER route <> s.row" \
+    "   THEN 'same travel as row ' || min(s.row) OVER route END," \
+    "  CASE WHEN s.number_of_seats < existing.paid_count" \
+    "   THEN 'number_of_seats is below the ' || existing.paid_count || ' seats already sold' END" \
+    " ], NULL) " \
+    "FROM typed s LEFT JOIN cities sc on sc.id = s.source_city LEFT JOIN cities dc on dc.id = s.destination_city " \
+    "LEFT JOIN archived_months am on am.month = date_trunc('month', s.travel_date) " \
+    "LEFT JOIN LATERAL (SELECT max(t.paid_count) AS paid_count FROM travels t WHERE t.agency_id = :agency_id" \
+    " AND t.source_city = s.source_city AND t.destination_city = s.destination_city" \
+    " AND t.travel_date = s.travel_date AND t.vehicle_type = s.vehicle_type) existing on true " \
+    "WINDOW route AS (PARTITION BY s.travel_date, s.vehicle_type, s.source_city, s.destination_city)"
+IMPORT_SUMMARY_QUERY = \
+    "SELECT count(*) FILTER (WHERE cardinality(errors) > 0) AS invalid, " \
+    "count(*) FILTER (WHERE existing) AS existing, count(*) AS total FROM travel_import_checked"
+IMPORT_MONTHS_QUERY = "SELECT DISTINCT date_trunc('month', travel_date)::date FROM travel_import_checked"
+IMPORT_ERRORS_QUERY = \
+    "SELECT row, errors FROM travel_import_checked WHERE cardinality(errors) > 0 ORDER BY row LIMIT :n"
+MERGE_TRAVELS_QUERY = \
+    "MERGE INTO travels t USING travel_import_checked s " \
+    "ON t.agency_id = :agency_id AND t.source_city = s.source_city AND t.destination_city = s.destination_city " \
+    "AND t.travel_date = s.travel_date AND t.vehicle_type = s.vehicle_type " \
+    "WHEN MATCHED AND (t.price, t.number_of_seats) IS DISTINCT FROM (s.price, s.number_of_seats) THEN " \
+    "UPDATE SET price = s.price, number_of_seats = s.number_of_seats " \
+    "WHEN NOT MATCHED THEN INSERT (travel_date, vehicle_type, price, number_of_seats, source_city, " \
+    "destination_city, agency_id) VALUES (s.travel_date, s.vehicle_type, s.price, s.number_of_seats, " \
+    "s.source_city, s.destination_city, :agency_id)"
+
+
+async def _lines(chunks):
+    decoder = codecs.getincrementaldecoder('utf-8-sig')()
+    pending = ''
+    line_no = 0
+    try:
+        async for chunk in chunks:
+            lines = (pending + decoder.decode(chunk)).split('\n')
+            pending = lines.pop()
+            for line in lines:
+                line_no += 1
+                yield line_no, line
+        pending += decoder.decode(b'', final=True)
+    except UnicodeDecodeError:
+        raise HTTPException(status_code=400, detail=f'line {line_no + 1} is not valid UTF-8')
+    if pending:
+        yield line_no + 1, pending
+
+
+def _value(value):
+    if value is None or isinstance(value, str):
+        return value
+    return json.dumps(value)
+
+
+async def _csv_rows(lines, errors):
+    header = None
+    record, first = '', None
+    async for line_no, line in lines:
+        record += line + '\n'
+        first = first or line_no
+        # a quoted field may contain newlines; the record is complete once its quotes are balanced
+        if record.count('"') % 2:
+            continue
+        row_no, values = first, next(csv.reader([record]), [])
+        record, first = '', None
+        if not values or values == ['']:
+            continue
+        if header is None:
+            header = [v.strip() for v in values]
+            if sorted(header) != sorted(TRAVEL_COLUMNS):
+                raise HTTPException(status_code=400,
+                                    detail=f"the header must name the columns {', '.join(TRAVEL_COLUMNS)}")
+            continue
+        if len(values) != len(header):
+            errors.append({'row': row_no, 'errors': [f'expected {len(header)} fields, got {len(values)}']})
+            continue
+        fields = dict(zip(header, values))
+        yield (row_no, *(fields[c] for c in TRAVEL_COLUMNS))
+    if record.strip():
+        errors.append({'row': first, 'errors': ['unterminated quoted field']})
+
+
+async def _ndjson_rows(lines, errors):
+    async for line_no, line in lines:
+        if not line.strip():
+            continue
+        try:
+            fields = json.loads(line)
+        except ValueError:
+            errors.append({'row': line_no, 'errors': ['not a JSON object']})
+            continue
+        if not isinstance(fields, dict):
+            errors.append({'row': line_no, 'errors': ['not a JSON object']})
+            continue
+        missing = [c for c in TRAVEL_COLUMNS if c not in fields]
+        if missing:
+            errors.append({'row': line_no, 'errors': [f'missing {c}' for c in missing]})
+            continue
+        yield (line_no, *(_value(fields[c]) for c in TRAVEL_COLUMNS))
+
+
+async def import_travels(conn, agency_id, chunks, import_format: ImportFormat):
+    """Merge a CSV or NDJSON timetable into the agency's travels, all rows or none.
+
+    The body is streamed through COPY into a staging table and checked there with a few set-based queries, so the
+    cost per row is a COPY row and a share of one MERGE rather than a round trip. Returns the merge counts or, if any
+    row is invalid, the errors of up to IMPORT_MAX_ERRORS rows and no changes.
+    """
+    start = time.perf_counter()
+    # rows that can't even be staged (wrong field count, malformed JSON) are reported alongside the checked ones
+    parse_errors = []
+    lines = _lines(chunks)
+    rows = _csv_rows(lines, parse_errors) if import_format == ImportFormat.CSV else _ndjson_rows(lines, parse_errors)
+    try:
+        # imports of one agency would otherwise both insert travels the other is inserting
+        await conn.execute(text("SELECT pg_advisory_xact_lock(hashtext('import_travels'), :agency_id)"),
+                           {'agency_id': agency_id})
+        await conn.execute(text(CREATE_STAGING_QUERY))
+        await conn.execute(text(CREATE_CHECKED_QUERY))
+        raw = await conn.get_raw_connection()
+        await raw.driver_connection.copy_records_to_table('travel_import', records=rows,
+                                                          columns=['row'] + TRAVEL_COLUMNS)
+        await conn.execute(text("ANALYZE travel_import"))
+        await conn.execute(text(CHECK_IMPORT_QUERY), {'agency_id': agency_id})
+        summary = (await conn.execute(text(IMPORT_SUMMARY_QUERY))).mappings().one()
+        errors = []
+        if parse_errors or summary['invalid']:
+            result = await conn.execute(text(IMPORT_ERRORS_QUERY), {'n': IMPORT_MAX_ERRORS})
+            errors = sorted(parse_errors + [dict(r) for r in result.mappings()], key=lambda e: e['row'])
+            await conn.rollback()
+            inserted = updated = 0
+        else:
+            await conn.execute(text("ANALYZE travel_import_checked"))
+            # in this transaction: creating a partition waits for the lock this one already holds on travels
+            months = month_partitions.missing((await conn.execute(text(IMPORT_MONTHS_QUERY))).scalars().all())
+            for m in months:
+                await conn.execute(text(ENSURE_PARTITIONS_QUERY), {'first': m, 'last': m})
+            await conn.execute(text(MERGE_TRAVELS_QUERY), {'agency_id': agency_id})
+            await conn.commit()
+            month_partitions.remember(months)
+            inserted, updated = summary['total'] - summary['existing'], summary['existing']
+    except HTTPException:
+        await conn.rollback()
+        raise
+    except Exception as e:
+        record_failure('import_travels', e)
+        await conn.rollback()
+        return False
+    seconds = time.perf_counter() - start
+    total = summary['total'] + len(parse_errors)
+    return {'rows': total, 'inserted': inserted, 'updated': updated,
+            'error_count': summary['invalid'] + len(parse_errors), 'errors': errors[:IMPORT_MAX_ERRORS],
+            'seconds': round(seconds, 3), 'rows_per_second': round(total / seconds) if seconds else None}
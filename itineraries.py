@@ -0,0 +1,224 @@
+import heapq
+import itertools
+import os
+import threading
+import time
+from bisect import bisect_left
+from datetime import datetime, timedelta
+from enum import Enum
+
+ITINERARY_GRAPH_TTL = int(os.environ.get('ITINERARY_GRAPH_TTL', 60))
+ITINERARY_MAX_LEGS = int(os.environ.get('ITINERARY_MAX_LEGS', 3))
+ITINERARY_MIN_CONNECTION_MINUTES = int(os.environ.get('ITINERARY_MIN_CONNECTION_MINUTES', 60))
+ITINERARY_MAX_HOURS = int(os.environ.get('ITINERARY_MAX_HOURS', 48))
+# how long a travel without an arrival_date is assumed to take
+DEFAULT_DURATION_HOURS = {
+    'bus': float(os.environ.get('ITINERARY_BUS_HOURS', 8)),
+    'train': float(os.environ.get('ITINERARY_TRAIN_HOURS', 10)),
+    'airplane': float(os.environ.get('ITINERARY_AIRPLANE_HOURS', 1.5)),
+}
+
+GRAPH_COLUMNS = \
+    "SELECT t.id, t.source_city, t.destination_city, t.travel_date, t.arrival_date, t.vehicle_type, t.price, " \
+    "t.remaining_seats, a.name AS agency_name FROM travels t JOIN agencies a on a.id = t.agency_id "
+GRAPH_QUERY = GRAPH_COLUMNS + "WHERE t.travel_date > now() AND t.remaining_seats > 0"
+# the travels of the given (source_city, destination_city, day) keys, for patching the graph after writes
+GRAPH_ROUTE_DAYS_QUERY = \
+    GRAPH_COLUMNS + "JOIN unnest(CAST(:sources AS int[]), CAST(:destinations AS int[]), CAST(:days AS date[])) " \
+    "k(source_city, destination_city, day) on t.source_city = k.source_city " \
+    "AND t.destination_city = k.destination_city AND t.travel_date >= k.day AND t.travel_date < k.day + 1 " \
+    "WHERE t.travel_date > now() AND t.remaining_seats > 0"
+
+
+class ItinerarySort(str, Enum):
+    FASTEST = 'fastest'
+    CHEAPEST = 'cheapest'
+
+
+class Leg:
+    __slots__ = ('id', 'source', 'destination', 'departure', 'arrival', 'estimated', 'vehicle_type', 'price',
+                 'remaining_seats', 'agency_name')
+
+    def __init__(self, r):
+        self.id = r['id']
+        self.source = r['source_city']
+        self.destination = r['destination_city']
+        self.departure = r['travel_date']
+        self.estimated = r['arrival_date'] is None
+        self.arrival = r['arrival_date'] or \
+            self.departure + timedelta(hours=DEFAULT_DURATION_HOURS.get(r['vehicle_type'], 8))
+        self.vehicle_type = r['vehicle_type']
+        self.price = r['price']
+        self.remaining_seats = r['remaining_seats']
+        self.agency_name = r['agency_name']
+
+    def route_day(self):
+        return self.source, self.destination, self.departure.date()
+
+    def as_dict(self):
+        return {'travel_id': self.id, 'source_city': self.source, 'destination_city': self.destination,
+                'travel_date': self.departure, 'arrival_date': self.arrival, 'arrival_estimated': self.estimated,
+                'vehicle_type': self.vehicle_type, 'price': self.price, 'remaining_seats': self.remaining_seats,
+                'agency_name': self.agency_name}
+
+
+def _departure(leg):
+    return leg.departure
+
+
+class ItineraryGraph:
+    # A time-expanded graph of the future travels that have seats left: for every city, the travels leaving it in
+    # order of departure. Writes mark the route and day they touched (the same keys the search cache drops), and the
+    # next search reloads just those travels; clear() or ITINERARY_GRAPH_TTL seconds cause a full reload, the latter
+    # to pick up writes made through other processes.
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.refreshing = threading.Lock()
+        self.departures = None
+        self.built = -1
+        self.cleared = -1
+        self.dirty = set()
+        self.builds = 0
+        self.patches = 0
+
+    def stale(self):
+        return self.departures is None or self.cleared >= self.built or self.built + self.ttl < time.monotonic()
+
+    def refresh(self, read_all, read_route_days):
+        """Bring the graph up to date before a search: read_all() returns the rows of GRAPH_QUERY and
+        read_route_days(keys) those of GRAPH_ROUTE_DAYS_QUERY for a set of keys, or False if the read failed."""
+        if not self.stale() and not self.dirty:
+            return
+        # one refresh at a time, so a full reload can't overwrite a newer patch with an older snapshot
+        with self.refreshing:
+            with self.lock:
+                # writes committed after this mark their keys again and are reloaded by the next refresh
+                keys, self.dirty = self.dirty, set()
+            if self.stale():
+                started = time.monotonic()
+                self.build(read_all(), started)
+            elif keys:
+                self.patch(keys, read_route_days(keys))
+
+    def build(self, rows, started):
+        # rows is the result of GRAPH_QUERY read after started; False (a failed read) keeps the old graph
+        if rows is False:
+            return
+        departures = {}
+        for r in rows:
+            leg = Leg(r)
+            departures.setdefault(leg.source, []).append(leg)
+        for legs in departures.values():
+            legs.sort(key=_departure)
+        with self.lock:
+            if started > self.built:
+                self.departures, self.built = departures, started
+                self.builds += 1
+
+    def patch(self, keys, rows):
+        # replaces the travels of every (source_city, destination_city, day) in keys with rows
+        if rows is False:
+            with self.lock:
+                self.dirty |= keys
+            return
+        fresh = {}
+        for r in rows:
+            leg = Leg(r)
+            fresh.setdefault(leg.source, []).append(leg)
+        with self.lock:
+            if self.departures is None:
+                return
+            for source in {k[0] for k in keys}:
+                # copied rather than changed in place so that searches running meanwhile see a consistent list
+                legs = [leg for leg in self.departures.get(source, ()) if leg.route_day() not in keys]
+                legs += fresh.get(source, [])
+                legs.sort(key=_departure)
+                self.departures[source] = legs
+            self.patches += 1
+
+    def changed(self, key):
+        with self.lock:
+            self.dirty.add(key)
+
+    def clear(self):
+        with self.lock:
+            self.cleared = time.monotonic()
+
+    def search(self, source, destination, day, sort: ItinerarySort, max_legs, min_connection, seats, limit):
+        """Up to limit itineraries from source to destination leaving on day, best first.
+
+        A best-first search over partial itineraries, ordered by arrival (fastest) or total price (cheapest); both
+        only grow as a leg is added, so the first complete itineraries popped are the best ones. A partial itinerary
+        is dropped when limit already expanded ones at the same city dominate it: they arrived no later, cost no
+        more, have as many legs and as much of ITINERARY_MAX_HOURS left, and passed through no city it hasn't. Each
+        of them can continue the way it would, so its completions can't be among the limit best.
+        """
+        departures = self.departures or {}
+        first = datetime.combine(day, datetime.min.time())
+        first_latest = first + timedelta(days=1)
+        first = max(first, datetime.now())
+        max_trip = timedelta(hours=ITINERARY_MAX_HOURS)
+        connection = timedelta(minutes=min_connection)
+        counter = itertools.count()
+
+        def key(path, price):
+            if sort == ItinerarySort.CHEAPEST:
+                return price, path[-1].arrival
+            return path[-1].arrival, price
+
+        def dominates(label, other):
+            return label[0] <= other[0] and label[1] <= other[1] and label[2] >= other[2] and \
+                label[3] <= other[3] and label[4] <= other[4]
+
+        heap = []
+        legs = departures.get(source, [])
+        for i in range(bisect_left(legs, first, key=_departure), len(legs)):
+            leg = legs[i]
+            if leg.departure >= first_latest:
+                break
+            if leg.remaining_seats >= seats and leg.arrival - leg.departure <= max_trip:
+                heap.append((key((leg,), leg.price), next(counter), (leg,), leg.price))
+        heapq.heapify(heap)
+
+        found = []
+        # per city, the (arrival, price, deadline, legs, visited cities) of the partial itineraries expanded there
+        labels = {}
+        while heap and len(found) < limit:
+            _, _, path, price = heapq.heappop(heap)
+            last = path[-1]
+            if last.destination == destination:
+                found.append(path)
+                continue
+            if len(path) >= max_legs:
+                continue
+            visited = frozenset(leg.source for leg in path)
+            latest_arrival = path[0].departure + max_trip
+            label = (last.arrival, price, latest_arrival, len(path), visited)
+            expanded = labels.setdefault(last.destination, [])
+            if sum(1 for other in expanded if dominates(other, label)) >= limit:
+                continue
+            expanded.append(label)
+            legs = departures.get(last.destination, [])
+            for i in range(bisect_left(legs, last.arrival + connection, key=_departure), len(legs)):
+                leg = legs[i]
+                if leg.departure >= latest_arrival:
+                    break
+                if leg.destination in visited or leg.remaining_seats < seats or leg.arrival > latest_arrival:
+                    continue
+                heapq.heappush(heap, (key(path + (leg,), price + leg.price), next(counter), path + (leg,),
+                                      price + leg.price))
+
+        return [{'departure': p[0].departure, 'arrival': p[-1].arrival,
+                 'duration_minutes': round((p[-1].arrival - p[0].departure).total_seconds() / 60),
+                 'price': sum(leg.price for leg in p), 'connections': len(p) - 1,
+                 'legs': [leg.as_dict() for leg in p]} for p in found]
+
+    def stats(self):
+        with self.lock:
+            return {'travels': sum(len(legs) for legs in self.departures.values()) if self.departures else 0,
+                    'builds': self.builds, 'patches': self.patches, 'pending': len(self.dirty),
+                    'age': round(time.monotonic() - self.built, 1) if self.departures else None, 'ttl': self.ttl}
+
+
+itinerary_graph = ItineraryGraph(ITINERARY_GRAPH_TTL)
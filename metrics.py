@@ -0,0 +1,245 @@
+import hashlib
+import logging
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+# statements slower than this many milliseconds go to the slow query log; a negative value turns it off
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', 200))
+SLOW_QUERY_LOG = os.environ.get('SLOW_QUERY_LOG')
+# upper bounds of the latency buckets, in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+ROW_BUCKETS = (0, 1, 5, 10, 50, 100, 500, 1000, 10000, 100000)
+
+slow_query_log = logging.getLogger('slow_query')
+if SLOW_QUERY_LOG:
+    _handler = logging.FileHandler(SLOW_QUERY_LOG)
+    _handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+    slow_query_log.addHandler(_handler)
+    slow_query_log.setLevel(logging.WARNING)
+    slow_query_log.propagate = False
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        # called with the Metrics lock held
+        i = 0
+        while i < len(self.buckets) and value > self.buckets[i]:
+            i += 1
+        self.counts[i] += 1
+        self.sum += value
+
+    def samples(self, name, labels):
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            yield f'{name}_bucket{{{labels}le="{bound}"}} {cumulative}'
+        cumulative += self.counts[-1]
+        yield f'{name}_bucket{{{labels}le="+Inf"}} {cumulative}'
+        yield f'{name}_sum{{{labels.rstrip(",")}}} {self.sum}'
+        yield f'{name}_count{{{labels.rstrip(",")}}} {cumulative}'
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(**labels):
+    return ''.join(f'{k}="{_label(v)}",' for k, v in labels.items())
+
+
+class Statement:
+    __slots__ = ('id', 'sql')
+
+    def __init__(self, sql):
+        self.sql = re.sub(r'\s+', ' ', sql).strip()
+        self.id = hashlib.sha1(self.sql.encode()).hexdigest()[:12]
+
+
+class Metrics:
+    # Latency histograms of every request by route and of every SQL statement, rows per statement, pool waits and
+    # errors, rendered in the Prometheus text format. Statements are labelled with a short digest of their SQL; the
+    # db_statement_info series maps each digest back to the statement.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.statements = {}
+        self.requests = {}
+        self.queries = {}
+        self.rows = {}
+        self.pool_waits = {}
+        self.sections = {}
+        self.errors = {}
+        self.admission_waits = {}
+        self.rejections = {}
+        self.slow_queries = 0
+
+    def statement(self, sql):
+        statement = self.statements.get(sql)
+        if statement is None:
+            statement = self.statements[sql] = Statement(sql)
+        return statement
+
+    def _observe(self, histograms, key, buckets, value):
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = Histogram(buckets)
+        histogram.observe(value)
+
+    def observe_request(self, method, route, status, seconds):
+        with self.lock:
+            self._observe(self.requests, (method, route, status), LATENCY_BUCKETS, seconds)
+
+    def observe_query(self, sql, parameters, seconds, rows):
+        statement = self.statement(sql)
+        with self.lock:
+            self._observe(self.queries, statement.id, LATENCY_BUCKETS, seconds)
+            if rows >= 0:
+                self._observe(self.rows, statement.id, ROW_BUCKETS, rows)
+        if 0 <= SLOW_QUERY_MS <= seconds * 1000:
+            with self.lock:
+                self.slow_queries += 1
+            # the parameter names and types, never their values: they include passwords and tokens
+            shape = ', '.join(f'{k}: {type(v).__name__}' for k, v in (parameters or {}).items()) \
+                if isinstance(parameters, dict) else type(parameters).__name__
+            slow_query_log.warning('slow query %s %.1f ms rows=%s params={%s} %s', statement.id, seconds * 1000,
+                                   rows, shape, statement.sql)
+
+    def observe_pool_wait(self, pool, seconds):
+        with self.lock:
+            self._observe(self.pool_waits, pool, LATENCY_BUCKETS, seconds)
+
+    def observe_admission_wait(self, workload, seconds):
+        with self.lock:
+            self._observe(self.admission_waits, workload, LATENCY_BUCKETS, seconds)
+
+    def record_rejection(self, workload, reason):
+        with self.lock:
+            self.rejections[(workload, reason)] = self.rejections.get((workload, reason), 0) + 1
+
+    @contextmanager
+    def section(self, name):
+        # times a part of a request, e.g. authorization, to tell it apart from the rest of the route's latency
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            with self.lock:
+                self._observe(self.sections, name, LATENCY_BUCKETS, seconds)
+
+    def record_error(self, where, e):
+        key = (where, type(e).__name__, getattr(getattr(e, 'orig', None), 'sqlstate', None) or '')
+        with self.lock:
+            self.errors[key] = self.errors.get(key, 0) + 1
+
+    def render(self, gauges=()):
+        lines = []
+        with self.lock:
+            lines += ['# HELP http_request_duration_seconds Latency of HTTP requests by route.',
+                      '# TYPE http_request_duration_seconds histogram']
+            for (method, route, status), h in self.requests.items():
+                lines += h.samples('http_request_duration_seconds', _labels(method=method, route=route,
+                                                                            status=status))
+            lines += ['# HELP db_query_duration_seconds Latency of SQL statements, by statement digest.',
+                      '# TYPE db_query_duration_seconds histogram']
+            for statement, h in self.queries.items():
+                lines += h.samples('db_query_duration_seconds', _labels(statement=statement))
+            lines += ['# HELP db_query_rows Rows returned or affected per SQL statement.',
+                      '# TYPE db_query_rows histogram']
+            for statement, h in self.rows.items():
+                lines += h.samples('db_query_rows', _labels(statement=statement))
+            lines += ['# HELP db_pool_wait_seconds Time spent waiting for a pooled connection.',
+                      '# TYPE db_pool_wait_seconds histogram']
+            for pool, h in self.pool_waits.items():
+                lines += h.samples('db_pool_wait_seconds', _labels(pool=pool))
+            lines += ['# HELP app_section_duration_seconds Latency of timed parts of requests.',
+                      '# TYPE app_section_duration_seconds histogram']
+            for section, h in self.sections.items():
+                lines += h.samples('app_section_duration_seconds', _labels(section=section))
+            lines += ['# HELP admission_queue_wait_seconds Time admitted requests queued, by workload class.',
+                      '# TYPE admission_queue_wait_seconds histogram']
+            for workload, h in self.admission_waits.items():
+                lines += h.samples('admission_queue_wait_seconds', _labels(workload=workload))
+            lines += ['# HELP admission_rejections_total Requests shed with a 503, by workload class and reason.',
+                      '# TYPE admission_rejections_total counter']
+            for (workload, reason), n in self.rejections.items():
+                lines.append(f'admission_rejections_total{{{_labels(workload=workload, reason=reason).rstrip(",")}}} {n}')
+            lines += ['# HELP db_errors_total Failed SQL statements by where they failed, type and SQLSTATE.',
+                      '# TYPE db_errors_total counter']
+            for (where, kind, sqlstate), n in self.errors.items():
+                lines.append(f'db_errors_total{{{_labels(where=where, type=kind, sqlstate=sqlstate).rstrip(",")}}} {n}')
+            lines += ['# HELP db_slow_queries_total Statements slower than SLOW_QUERY_MS.',
+                      '# TYPE db_slow_queries_total counter', f'db_slow_queries_total {self.slow_queries}']
+            statements = {s.id: s for s in self.statements.values()}.values()
+        lines += ['# HELP db_statement_info The SQL of each statement digest.', '# TYPE db_statement_info gauge']
+        for s in statements:
+            lines.append(f'db_statement_info{{{_labels(statement=s.id, sql=s.sql).rstrip(",")}}} 1')
+        # a family's series must be contiguous and its HELP and TYPE given once
+        families = {}
+        for name, help_text, value, labels in gauges:
+            families.setdefault((name, help_text), []).append(
+                f'{name}{{{_labels(**labels).rstrip(",")}}} {value}' if labels else f'{name} {value}')
+        for (name, help_text), samples in families.items():
+            lines += [f'# HELP {name} {help_text}', f'# TYPE {name} gauge'] + samples
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+def instrument_engine(engine):
+    """Time every statement the engine runs. Pass an AsyncEngine's sync_engine for the async pool."""
+    if not METRICS_ENABLED:
+        return
+    from sqlalchemy import event
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after(conn, cursor, statement, parameters, context, executemany):
+        seconds = time.perf_counter() - conn.info['query_start'].pop()
+        metrics.observe_query(statement, parameters, seconds, cursor.rowcount)
+
+    @event.listens_for(engine, 'handle_error')
+    def failed(context):
+        # a statement that raised never reaches after_cursor_execute
+        starts = context.connection.info.get('query_start') if context.connection is not None else None
+        if starts:
+            starts.pop()
+
+
+class MetricsMiddleware:
+    # Plain ASGI middleware rather than @app.middleware('http'): it adds no task or body streaming of its own to
+    # every request, only two clock reads and a dictionary update.
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or not METRICS_ENABLED:
+            return await self.app(scope, receive, send)
+        start = time.perf_counter()
+        status = 500
+
+        async def send_status(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_status)
+        finally:
+            route = scope.get('route')
+            # unmatched paths share one label so that scanners can't grow the series without bound
+            metrics.observe_request(scope['method'], getattr(route, 'path', 'unmatched'), status,
+                                    time.perf_counter() - start)
@@ -0,0 +1,65 @@
+"""Apply the SQL files in migrations/ that the database hasn't seen yet, in order.
+
+    python migrate.py                      apply pending migrations
+    python migrate.py --list               show applied and pending versions
+    python migrate.py --mark-applied 002   record versions up to 002 as applied without running them
+
+The version of a migration is the number its file name starts with. Each file runs in its own transaction.
+"""
+import argparse
+import os
+import re
+import sys
+
+from sqlalchemy import create_engine, text
+
+from database import DATABASE_URL
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+
+
+def available_migrations():
+    migrations = []
+    for name in sorted(os.listdir(MIGRATIONS_DIR)):
+        m = re.match(r'^(\d+)_.*\.sql$', name)
+        if m:
+            migrations.append((m.group(1), os.path.join(MIGRATIONS_DIR, name)))
+    return migrations
+
+
+def applied_versions(conn):
+    conn.execute(text("CREATE TABLE IF NOT EXISTS schema_migrations (version text primary key, "
+                      "applied_at timestamp not null default now())"))
+    conn.commit()
+    return {r[0] for r in conn.execute(text("SELECT version FROM schema_migrations"))}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database-url', default=DATABASE_URL)
+    parser.add_argument('--list', action='store_true')
+    parser.add_argument('--mark-applied', metavar='VERSION')
+    args = parser.parse_args()
+
+    engine = create_engine(args.database_url)
+    with engine.connect() as conn:
+        applied = applied_versions(conn)
+        pending = [(v, path) for v, path in available_migrations() if v not in applied]
+        if args.list:
+            for version, path in available_migrations():
+                print(('applied ' if version in applied else 'pending ') + os.path.basename(path))
+            return
+        for version, path in pending:
+            if args.mark_applied and version > args.mark_applied:
+                break
+            if not args.mark_applied:
+                with open(path) as f:
+                    # the raw driver connection runs the whole file as one simple-protocol script
+                    conn.connection.driver_connection.cursor().execute(f.read())
+            conn.execute(text("INSERT INTO schema_migrations(version) VALUES (:v)"), {'v': version})
+            conn.commit()
+            print(('marked ' if args.mark_applied else 'applied ') + os.path.basename(path))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
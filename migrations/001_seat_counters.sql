@@ -0,0 +1,96 @@
+-- Keep the number of paid tickets on each travel instead of counting them on every read.
+
+ALTER TABLE travels
+    ADD COLUMN IF NOT EXISTS paid_count int NOT NULL DEFAULT 0,
+    ADD CONSTRAINT positive_paid_count check ( paid_count >= 0 );
+ALTER TABLE travels
+    ADD COLUMN IF NOT EXISTS remaining_seats int GENERATED ALWAYS AS ( number_of_seats - paid_count ) STORED;
+
+UPDATE travels t
+SET paid_count = (select count(*) from tickets where travel_id = t.id and status = 'paid');
+
+CREATE OR REPLACE FUNCTION check_tickets_violations() RETURNS trigger AS
+$check_tickets_violations$
+BEGIN
+    IF TG_OP = 'INSERT' AND (select remaining_seats FROM travels WHERE id = NEW.travel_id) <= 0 THEN
+        RAISE EXCEPTION 'travel is full';
+    END IF;
+    IF new.rating is not null and (select travel_date from travels where new.travel_id = id) > now() THEN
+        RAISE EXCEPTION 'you can not rate before travel date';
+    end if;
+    IF OLD.status = 'paid' AND OLD.discount_code != new.discount_code THEN
+        RAISE EXCEPTION 'can not change discount_code after paying';
+    end if;
+
+    RETURN NEW;
+END;
+$check_tickets_violations$ LANGUAGE plpgsql;
+
+-- The seat check and the increment are one conditional UPDATE, so two buyers can't both take the last seat.
+CREATE FUNCTION count_paid_tickets() RETURNS trigger AS
+$count_paid_tickets$
+BEGIN
+    IF TG_OP = 'UPDATE' AND OLD.status = NEW.status AND OLD.travel_id = NEW.travel_id THEN
+        RETURN NULL;
+    END IF;
+    IF TG_OP IN ('UPDATE', 'DELETE') AND OLD.status = 'paid' THEN
+        UPDATE travels SET paid_count = paid_count - 1 WHERE id = OLD.travel_id;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') AND NEW.status = 'paid' THEN
+        UPDATE travels SET paid_count = paid_count + 1 WHERE id = NEW.travel_id AND paid_count < number_of_seats;
+        IF NOT FOUND THEN
+            RAISE EXCEPTION 'travel is full';
+        END IF;
+    END IF;
+    RETURN NULL;
+END;
+$count_paid_tickets$ LANGUAGE plpgsql;
+CREATE TRIGGER count_paid_tickets
+    AFTER INSERT OR DELETE OR UPDATE OF status, travel_id
+    ON tickets
+    FOR ROW
+EXECUTE FUNCTION count_paid_tickets();
+
+CREATE OR REPLACE VIEW travels_with_remaining_seats AS
+SELECT t.id,
+       vehicle_type,
+       source_city,
+       destination_city,
+       t.price,
+       number_of_seats,
+       travel_date,
+       agency_id,
+       a.name                                                                                        as agency_name,
+       t.remaining_seats::bigint                                                                     as remaining_seats,
+       (select SUM(t2.price) from tickets_with_price t2 where travel_id = t.id and status = 'paid')  as saleing,
+       (select AVG(t2.rating) from tickets_with_price t2 where travel_id = t.id and status = 'paid') as rating
+
+FROM travels AS t
+         join agencies a on a.id = t.agency_id;
+
+-- Lists travels whose stored counter disagrees with the tickets table; with fix => true also corrects them.
+CREATE FUNCTION reconcile_paid_counts(fix bool default false)
+    RETURNS TABLE
+            (
+                travel_id  int,
+                paid_count int,
+                actual     int
+            )
+AS
+$reconcile_paid_counts$
+BEGIN
+    RETURN QUERY
+        SELECT t.id, t.paid_count, c.actual::int
+        FROM travels t
+                 CROSS JOIN LATERAL (select count(*) as actual
+                                     from tickets tk
+                                     where tk.travel_id = t.id
+                                       and tk.status = 'paid') c
+        WHERE t.paid_count != c.actual;
+    IF fix THEN
+        UPDATE travels t
+        SET paid_count = (select count(*) from tickets tk where tk.travel_id = t.id and tk.status = 'paid')
+        WHERE t.paid_count != (select count(*) from tickets tk where tk.travel_id = t.id and tk.status = 'paid');
+    END IF;
+END;
+$reconcile_paid_counts$ LANGUAGE plpgsql;
@@ -0,0 +1,70 @@
+-- Price tickets through joins instead of scalar subqueries, and freeze the price a ticket was paid at.
+
+CREATE FUNCTION discounted_price(price int, percent int, maximum_limit int) RETURNS int AS
+$discounted_price$
+SELECT CASE
+           WHEN percent is null then price
+           WHEN price * (100 - percent) / 100 < price - maximum_limit then price - maximum_limit
+           ELSE price * (100 - percent) / 100
+           END
+$discounted_price$ LANGUAGE sql IMMUTABLE;
+
+ALTER TABLE tickets
+    ADD COLUMN IF NOT EXISTS paid_price int;
+
+UPDATE tickets t
+SET paid_price = (select discounted_price(tr.price, d.percent, d.maximum_limit)
+                  from travels tr
+                           left join discounts d on d.code = t.discount_code
+                  where tr.id = t.travel_id)
+WHERE t.status = 'paid';
+
+CREATE FUNCTION freeze_ticket_price() RETURNS trigger AS
+$freeze_ticket_price$
+BEGIN
+    IF NEW.status != 'paid' THEN
+        NEW.paid_price := null;
+    ELSIF TG_OP = 'INSERT' OR OLD.status != 'paid' THEN
+        NEW.paid_price := (select discounted_price(tr.price, d.percent, d.maximum_limit)
+                           from travels tr
+                                    left join discounts d on d.code = NEW.discount_code
+                           where tr.id = NEW.travel_id);
+    END IF;
+    RETURN NEW;
+END;
+$freeze_ticket_price$ LANGUAGE plpgsql;
+CREATE TRIGGER freeze_ticket_price
+    BEFORE INSERT OR UPDATE OF status
+    ON tickets
+    FOR ROW
+EXECUTE FUNCTION freeze_ticket_price();
+
+-- Paid tickets report the price they were paid at; unpaid ones the price they would cost now.
+CREATE OR REPLACE VIEW tickets_with_price AS
+SELECT t.id,
+       t.user_id,
+       t.status,
+       t.travel_id,
+       t.rating,
+       t.discount_code,
+       coalesce(t.paid_price, discounted_price(tr.price, d.percent, d.maximum_limit)) as price
+FROM tickets AS t
+         join travels tr on tr.id = t.travel_id
+         left join discounts d on d.code = t.discount_code;
+
+CREATE OR REPLACE VIEW travels_with_remaining_seats AS
+SELECT t.id,
+       vehicle_type,
+       source_city,
+       destination_city,
+       t.price,
+       number_of_seats,
+       travel_date,
+       agency_id,
+       a.name                                                                                     as agency_name,
+       t.remaining_seats::bigint                                                                  as remaining_seats,
+       (select SUM(t2.paid_price) from tickets t2 where travel_id = t.id and status = 'paid') as saleing,
+       (select AVG(t2.rating) from tickets t2 where travel_id = t.id and status = 'paid')     as rating
+
+FROM travels AS t
+         join agencies a on a.id = t.agency_id;
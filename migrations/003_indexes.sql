@@ -0,0 +1,22 @@
+-- Indexes for the predicates the endpoints in main.py actually filter and join on.
+
+-- per-travel seat, sales and rating lookups; INCLUDE lets them run as index-only scans
+CREATE INDEX IF NOT EXISTS tickets_travel_status_idx ON tickets (travel_id, status) INCLUDE (paid_price, rating);
+-- filter_tickets, top_5_customers and the passenger's own tickets
+CREATE INDEX IF NOT EXISTS tickets_user_idx ON tickets (user_id);
+-- ON DELETE SET NULL from discounts
+CREATE INDEX IF NOT EXISTS tickets_discount_code_idx ON tickets (discount_code) WHERE discount_code IS NOT NULL;
+
+-- get_possible_travels_for_passenger_with_exact_params
+CREATE INDEX IF NOT EXISTS travels_route_date_idx ON travels (source_city, destination_city, travel_date);
+-- get_travels, highest_rating, get_highest_income and the other per-agency statistics
+CREATE INDEX IF NOT EXISTS travels_agency_date_idx ON travels (agency_id, travel_date);
+-- get_possible_travels_for_passenger (travel_date > now())
+CREATE INDEX IF NOT EXISTS travels_date_idx ON travels (travel_date);
+-- most_popular_destination and ON DELETE CASCADE from cities
+CREATE INDEX IF NOT EXISTS travels_destination_idx ON travels (destination_city);
+
+-- get_messages
+CREATE INDEX IF NOT EXISTS messages_support_date_idx ON messages (support_id, message_date);
+-- get_support_tickets and the passenger check in get_messages/send_messages
+CREATE INDEX IF NOT EXISTS support_tickets_passenger_idx ON support_tickets (passenger_id);
@@ -0,0 +1,8 @@
+-- Keyset pagination orders by (sort key, id); with id in the index a page after any cursor starts with an index seek.
+
+-- get_possible_travels_for_passenger pages by (travel_date, id)
+DROP INDEX IF EXISTS travels_date_idx;
+CREATE INDEX IF NOT EXISTS travels_date_id_idx ON travels (travel_date, id);
+-- filter_tickets pages the passenger's own tickets, by id unless asked otherwise
+DROP INDEX IF EXISTS tickets_user_idx;
+CREATE INDEX IF NOT EXISTS tickets_user_id_idx ON tickets (user_id, id);
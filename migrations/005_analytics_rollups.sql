@@ -0,0 +1,305 @@
+-- Roll paid tickets up into small tables kept current by triggers, so the manager statistics don't aggregate
+-- the tickets table on every request. Every rollup is keyed by the travel's month and destination, not the payment's.
+
+CREATE TABLE IF NOT EXISTS travel_sales
+(
+    travel_id    int primary key,
+    agency_id    int     not null,
+    sales        bigint  not null default 0,
+    rating_sum   bigint  not null default 0,
+    rating_count int     not null default 0,
+    rating       numeric generated always as ( CASE WHEN rating_count > 0 THEN rating_sum::numeric / rating_count END ) stored,
+    constraint travel_sales_travel_fk foreign key (travel_id) references travels on delete cascade on update cascade
+);
+CREATE INDEX IF NOT EXISTS travel_sales_sales_idx ON travel_sales (sales desc);
+CREATE INDEX IF NOT EXISTS travel_sales_agency_rating_idx ON travel_sales (agency_id, rating desc) WHERE rating IS NOT NULL;
+
+-- Paying for any travel of an agency updates its row for the month. Spreading each key over a few shards (by
+-- ticket id) keeps concurrent payments from queueing on one row lock; readers sum the shards.
+CREATE TABLE IF NOT EXISTS agency_monthly_income
+(
+    agency_id  int      not null,
+    month      date     not null,
+    shard      smallint not null,
+    income     bigint   not null default 0,
+    paid_count int      not null default 0,
+    primary key (agency_id, month, shard)
+);
+
+CREATE TABLE IF NOT EXISTS agency_destination_sales
+(
+    agency_id        int      not null,
+    destination_city int      not null,
+    shard            smallint not null,
+    paid_count       int      not null default 0,
+    primary key (agency_id, destination_city, shard)
+);
+
+CREATE TABLE IF NOT EXISTS user_monthly_spend
+(
+    user_id          int    not null,
+    month            date   not null,
+    destination_city int    not null,
+    spend            bigint not null default 0,
+    paid_count       int    not null default 0,
+    primary key (user_id, month, destination_city)
+);
+-- top_5_customers asks for a month of the year
+CREATE INDEX IF NOT EXISTS user_monthly_spend_month_idx ON user_monthly_spend (date_part('month', month));
+
+-- The rollups computed from scratch; rebuild_rollups() copies them and rollup_mismatches() compares against them.
+CREATE VIEW travel_sales_from_tickets AS
+SELECT t.id                                                      as travel_id,
+       t.agency_id,
+       coalesce(sum(tk.paid_price), 0)                           as sales,
+       coalesce(sum(tk.rating), 0)                               as rating_sum,
+       count(tk.rating)::int                                     as rating_count
+FROM travels t
+         left join tickets tk on tk.travel_id = t.id and tk.status = 'paid'
+GROUP BY t.id;
+
+CREATE VIEW agency_monthly_income_from_tickets AS
+SELECT t.agency_id, date_trunc('month', t.travel_date)::date as month, (tk.id % 8)::smallint as shard,
+       coalesce(sum(tk.paid_price), 0) as income, count(*)::int as paid_count
+FROM tickets tk
+         join travels t on t.id = tk.travel_id
+WHERE tk.status = 'paid'
+GROUP BY 1, 2, 3;
+
+CREATE VIEW agency_destination_sales_from_tickets AS
+SELECT t.agency_id, t.destination_city, (tk.id % 8)::smallint as shard, count(*)::int as paid_count
+FROM tickets tk
+         join travels t on t.id = tk.travel_id
+WHERE tk.status = 'paid'
+GROUP BY 1, 2, 3;
+
+CREATE VIEW user_monthly_spend_from_tickets AS
+SELECT tk.user_id, date_trunc('month', t.travel_date)::date as month, t.destination_city,
+       coalesce(sum(tk.paid_price), 0) as spend, count(*)::int as paid_count
+FROM tickets tk
+         join travels t on t.id = tk.travel_id
+WHERE tk.status = 'paid'
+GROUP BY 1, 2, 3;
+
+-- Adds (sign = 1) or removes (sign = -1) one paid ticket.
+CREATE FUNCTION add_ticket_to_rollups(tk tickets, sign int) RETURNS void AS
+$add_ticket_to_rollups$
+DECLARE
+    tr           travels%ROWTYPE;
+    travel_month date;
+BEGIN
+    SELECT * INTO tr FROM travels WHERE id = tk.travel_id;
+    -- tickets deleted along with their travel; remove_travel_from_rollups already took the travel out
+    IF NOT FOUND THEN
+        RETURN;
+    END IF;
+    travel_month := date_trunc('month', tr.travel_date)::date;
+    INSERT INTO travel_sales AS s (travel_id, agency_id, sales, rating_sum, rating_count)
+    VALUES (tr.id, tr.agency_id, sign * coalesce(tk.paid_price, 0), sign * coalesce(tk.rating, 0),
+            sign * (tk.rating IS NOT NULL)::int)
+    ON CONFLICT (travel_id) DO UPDATE SET sales        = s.sales + excluded.sales,
+                                          rating_sum   = s.rating_sum + excluded.rating_sum,
+                                          rating_count = s.rating_count + excluded.rating_count;
+    INSERT INTO agency_monthly_income AS s (agency_id, month, shard, income, paid_count)
+    VALUES (tr.agency_id, travel_month, tk.id % 8, sign * coalesce(tk.paid_price, 0), sign)
+    ON CONFLICT (agency_id, month, shard) DO UPDATE SET income     = s.income + excluded.income,
+                                                        paid_count = s.paid_count + excluded.paid_count;
+    INSERT INTO agency_destination_sales AS s (agency_id, destination_city, shard, paid_count)
+    VALUES (tr.agency_id, tr.destination_city, tk.id % 8, sign)
+    ON CONFLICT (agency_id, destination_city, shard) DO UPDATE SET paid_count = s.paid_count + excluded.paid_count;
+    INSERT INTO user_monthly_spend AS s (user_id, month, destination_city, spend, paid_count)
+    VALUES (tk.user_id, travel_month, tr.destination_city, sign * coalesce(tk.paid_price, 0), sign)
+    ON CONFLICT (user_id, month, destination_city) DO UPDATE SET spend      = s.spend + excluded.spend,
+                                                                 paid_count = s.paid_count + excluded.paid_count;
+END;
+$add_ticket_to_rollups$ LANGUAGE plpgsql;
+
+CREATE FUNCTION maintain_ticket_rollups() RETURNS trigger AS
+$maintain_ticket_rollups$
+BEGIN
+    IF TG_OP = 'UPDATE' AND OLD.status = NEW.status AND OLD.travel_id = NEW.travel_id AND OLD.user_id = NEW.user_id
+        AND OLD.paid_price IS NOT DISTINCT FROM NEW.paid_price THEN
+        -- a rating only changes the travel's rating
+        IF NEW.status = 'paid' AND OLD.rating IS DISTINCT FROM NEW.rating THEN
+            UPDATE travel_sales
+            SET rating_sum   = rating_sum - coalesce(OLD.rating, 0) + coalesce(NEW.rating, 0),
+                rating_count = rating_count - (OLD.rating IS NOT NULL)::int + (NEW.rating IS NOT NULL)::int
+            WHERE travel_id = NEW.travel_id;
+        END IF;
+        RETURN NULL;
+    END IF;
+    IF TG_OP IN ('UPDATE', 'DELETE') AND OLD.status = 'paid' THEN
+        PERFORM add_ticket_to_rollups(OLD, -1);
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') AND NEW.status = 'paid' THEN
+        PERFORM add_ticket_to_rollups(NEW, 1);
+    END IF;
+    RETURN NULL;
+END;
+$maintain_ticket_rollups$ LANGUAGE plpgsql;
+CREATE TRIGGER maintain_ticket_rollups
+    AFTER INSERT OR DELETE OR UPDATE OF status, travel_id, user_id, rating, paid_price
+    ON tickets
+    FOR ROW
+EXECUTE FUNCTION maintain_ticket_rollups();
+
+-- Adds or removes all paid tickets of a travel under its agency, month and destination.
+CREATE FUNCTION add_travel_to_rollups(tr travels, sign int) RETURNS void AS
+$add_travel_to_rollups$
+BEGIN
+    INSERT INTO agency_monthly_income AS s (agency_id, month, shard, income, paid_count)
+    SELECT tr.agency_id, date_trunc('month', tr.travel_date)::date, tk.id % 8,
+           sign * coalesce(sum(tk.paid_price), 0), sign * count(*)
+    FROM tickets tk
+    WHERE tk.travel_id = tr.id
+      AND tk.status = 'paid'
+    GROUP BY tk.id % 8
+    ON CONFLICT (agency_id, month, shard) DO UPDATE SET income     = s.income + excluded.income,
+                                                        paid_count = s.paid_count + excluded.paid_count;
+    INSERT INTO agency_destination_sales AS s (agency_id, destination_city, shard, paid_count)
+    SELECT tr.agency_id, tr.destination_city, tk.id % 8, sign * count(*)
+    FROM tickets tk
+    WHERE tk.travel_id = tr.id
+      AND tk.status = 'paid'
+    GROUP BY tk.id % 8
+    ON CONFLICT (agency_id, destination_city, shard) DO UPDATE SET paid_count = s.paid_count + excluded.paid_count;
+    INSERT INTO user_monthly_spend AS s (user_id, month, destination_city, spend, paid_count)
+    SELECT tk.user_id, date_trunc('month', tr.travel_date)::date, tr.destination_city,
+           sign * coalesce(sum(tk.paid_price), 0), sign * count(*)
+    FROM tickets tk
+    WHERE tk.travel_id = tr.id
+      AND tk.status = 'paid'
+    GROUP BY tk.user_id
+    ON CONFLICT (user_id, month, destination_city) DO UPDATE SET spend      = s.spend + excluded.spend,
+                                                                 paid_count = s.paid_count + excluded.paid_count;
+END;
+$add_travel_to_rollups$ LANGUAGE plpgsql;
+
+CREATE FUNCTION move_travel_in_rollups() RETURNS trigger AS
+$move_travel_in_rollups$
+BEGIN
+    PERFORM add_travel_to_rollups(OLD, -1);
+    PERFORM add_travel_to_rollups(NEW, 1);
+    UPDATE travel_sales SET agency_id = NEW.agency_id WHERE travel_id = NEW.id AND agency_id != NEW.agency_id;
+    RETURN NULL;
+END;
+$move_travel_in_rollups$ LANGUAGE plpgsql;
+CREATE TRIGGER move_travel_in_rollups
+    AFTER UPDATE OF travel_date, destination_city, agency_id
+    ON travels
+    FOR ROW
+    WHEN ( date_trunc('month', OLD.travel_date) != date_trunc('month', NEW.travel_date)
+        OR OLD.destination_city != NEW.destination_city OR OLD.agency_id != NEW.agency_id )
+EXECUTE FUNCTION move_travel_in_rollups();
+
+-- Runs before the cascade deletes the tickets, while they can still be attributed to the travel.
+CREATE FUNCTION remove_travel_from_rollups() RETURNS trigger AS
+$remove_travel_from_rollups$
+BEGIN
+    PERFORM add_travel_to_rollups(OLD, -1);
+    RETURN OLD;
+END;
+$remove_travel_from_rollups$ LANGUAGE plpgsql;
+CREATE TRIGGER remove_travel_from_rollups
+    BEFORE DELETE
+    ON travels
+    FOR ROW
+EXECUTE FUNCTION remove_travel_from_rollups();
+
+-- Recomputes every rollup from the tickets table. Blocks ticket writes until it commits.
+CREATE FUNCTION rebuild_rollups() RETURNS void AS
+$rebuild_rollups$
+BEGIN
+    LOCK TABLE travel_sales, agency_monthly_income, agency_destination_sales, user_monthly_spend;
+    TRUNCATE travel_sales, agency_monthly_income, agency_destination_sales, user_monthly_spend;
+    INSERT INTO travel_sales(travel_id, agency_id, sales, rating_sum, rating_count)
+    SELECT travel_id, agency_id, sales, rating_sum, rating_count
+    FROM travel_sales_from_tickets;
+    INSERT INTO agency_monthly_income(agency_id, month, shard, income, paid_count)
+    SELECT agency_id, month, shard, income, paid_count
+    FROM agency_monthly_income_from_tickets;
+    INSERT INTO agency_destination_sales(agency_id, destination_city, shard, paid_count)
+    SELECT agency_id, destination_city, shard, paid_count
+    FROM agency_destination_sales_from_tickets;
+    INSERT INTO user_monthly_spend(user_id, month, destination_city, spend, paid_count)
+    SELECT user_id, month, destination_city, spend, paid_count
+    FROM user_monthly_spend_from_tickets;
+END;
+$rebuild_rollups$ LANGUAGE plpgsql;
+
+-- Lists rollup keys whose stored totals disagree with the tickets table. Shards are summed, and keys that are
+-- missing on one side count as zero.
+CREATE FUNCTION rollup_mismatches()
+    RETURNS TABLE
+            (
+                rollup text,
+                key    text,
+                stored text,
+                actual text
+            )
+AS
+$rollup_mismatches$
+SELECT 'travel_sales', coalesce(s.travel_id, a.travel_id)::text,
+       row (s.sales, s.rating_sum, s.rating_count)::text, row (a.sales, a.rating_sum, a.rating_count)::text
+FROM travel_sales s
+         full join travel_sales_from_tickets a on a.travel_id = s.travel_id
+WHERE row (coalesce(s.sales, 0), coalesce(s.rating_sum, 0), coalesce(s.rating_count, 0))
+          != row (coalesce(a.sales, 0), coalesce(a.rating_sum, 0), coalesce(a.rating_count, 0))
+   OR s.agency_id != a.agency_id
+UNION ALL
+SELECT 'agency_monthly_income', row (agency_id, month)::text,
+       row (sum(s_income), sum(s_count))::text, row (sum(a_income), sum(a_count))::text
+FROM (SELECT agency_id, month, income as s_income, paid_count as s_count, 0 as a_income, 0 as a_count
+      FROM agency_monthly_income
+      UNION ALL
+      SELECT agency_id, month, 0, 0, income, paid_count
+      FROM agency_monthly_income_from_tickets) x
+GROUP BY agency_id, month
+HAVING sum(s_income) != sum(a_income)
+    OR sum(s_count) != sum(a_count)
+UNION ALL
+SELECT 'agency_destination_sales', row (agency_id, destination_city)::text,
+       sum(s_count)::text, sum(a_count)::text
+FROM (SELECT agency_id, destination_city, paid_count as s_count, 0 as a_count
+      FROM agency_destination_sales
+      UNION ALL
+      SELECT agency_id, destination_city, 0, paid_count
+      FROM agency_destination_sales_from_tickets) x
+GROUP BY agency_id, destination_city
+HAVING sum(s_count) != sum(a_count)
+UNION ALL
+SELECT 'user_monthly_spend', row (user_id, month, destination_city)::text,
+       row (sum(s_spend), sum(s_count))::text, row (sum(a_spend), sum(a_count))::text
+FROM (SELECT user_id, month, destination_city, spend as s_spend, paid_count as s_count, 0 as a_spend, 0 as a_count
+      FROM user_monthly_spend
+      UNION ALL
+      SELECT user_id, month, destination_city, 0, 0, spend, paid_count
+      FROM user_monthly_spend_from_tickets) x
+GROUP BY user_id, month, destination_city
+HAVING sum(s_spend) != sum(a_spend)
+    OR sum(s_count) != sum(a_count)
+$rollup_mismatches$ LANGUAGE sql;
+
+SELECT rebuild_rollups();
+
+CREATE OR REPLACE VIEW travels_with_remaining_seats AS
+SELECT t.id,
+       vehicle_type,
+       source_city,
+       destination_city,
+       t.price,
+       number_of_seats,
+       travel_date,
+       t.agency_id,
+       a.name                                                 as agency_name,
+       t.remaining_seats::bigint                              as remaining_seats,
+       CASE WHEN t.paid_count > 0 THEN coalesce(s.sales, 0) END as saleing,
+       s.rating                                               as rating
+
+FROM travels AS t
+         join agencies a on a.id = t.agency_id
+         left join travel_sales s on s.travel_id = t.id;
+
+CREATE OR REPLACE VIEW agencies_with_rating AS
+SELECT *, (select AVG(rating) FROM travel_sales WHERE agency_id = a.id) AS rating
+FROM agencies a;
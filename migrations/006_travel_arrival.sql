@@ -0,0 +1,6 @@
+-- Arrival times for the connection search (itineraries.py). Travels without one are assumed to take a default
+-- time for their vehicle type.
+
+ALTER TABLE travels
+    ADD COLUMN IF NOT EXISTS arrival_date timestamp,
+    ADD CONSTRAINT arrival_after_departure check ( arrival_date > travel_date );
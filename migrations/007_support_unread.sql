@@ -0,0 +1,65 @@
+-- Unread counters on every support thread and a notification for every new message, so that clients can wait on
+-- /support_events and look at the counters instead of polling get_messages.
+-- passenger_unread counts the unseen messages of staff in the thread, staff_unread those of its passenger.
+
+ALTER TABLE support_tickets
+    ADD COLUMN IF NOT EXISTS passenger_unread int NOT NULL DEFAULT 0,
+    ADD COLUMN IF NOT EXISTS staff_unread     int NOT NULL DEFAULT 0,
+    ADD COLUMN IF NOT EXISTS last_message_id  int;
+
+UPDATE support_tickets s
+SET passenger_unread = c.passenger_unread,
+    staff_unread     = c.staff_unread,
+    last_message_id  = c.last_message_id
+FROM (SELECT m.support_id,
+             count(*) FILTER (WHERE NOT m.is_seen AND m.sender_id != st.passenger_id) AS passenger_unread,
+             count(*) FILTER (WHERE NOT m.is_seen AND m.sender_id = st.passenger_id)  AS staff_unread,
+             max(m.id)                                                                 AS last_message_id
+      FROM messages m
+               JOIN support_tickets st on st.id = m.support_id
+      GROUP BY m.support_id) c
+WHERE s.id = c.support_id;
+
+CREATE FUNCTION count_unread_messages() RETURNS trigger AS
+$count_unread_messages$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        UPDATE support_tickets
+        SET passenger_unread = passenger_unread + (NOT NEW.is_seen AND NEW.sender_id != passenger_id)::int,
+            staff_unread     = staff_unread + (NOT NEW.is_seen AND NEW.sender_id = passenger_id)::int,
+            last_message_id  = greatest(last_message_id, NEW.id)
+        WHERE id = NEW.support_id;
+        -- delivered when the transaction commits; listeners then fetch the messages after the last one they sent
+        PERFORM pg_notify('support_messages', NEW.support_id || ' ' || NEW.id);
+        RETURN NULL;
+    END IF;
+    IF TG_OP = 'UPDATE' AND OLD.is_seen = NEW.is_seen AND OLD.sender_id = NEW.sender_id
+        AND OLD.support_id = NEW.support_id THEN
+        RETURN NULL;
+    END IF;
+    IF NOT OLD.is_seen THEN
+        UPDATE support_tickets
+        SET passenger_unread = passenger_unread - (OLD.sender_id != passenger_id)::int,
+            staff_unread     = staff_unread - (OLD.sender_id = passenger_id)::int
+        WHERE id = OLD.support_id;
+    END IF;
+    IF TG_OP = 'UPDATE' AND NOT NEW.is_seen THEN
+        UPDATE support_tickets
+        SET passenger_unread = passenger_unread + (NEW.sender_id != passenger_id)::int,
+            staff_unread     = staff_unread + (NEW.sender_id = passenger_id)::int
+        WHERE id = NEW.support_id;
+    END IF;
+    RETURN NULL;
+END;
+$count_unread_messages$ LANGUAGE plpgsql;
+CREATE TRIGGER count_unread_messages
+    AFTER INSERT OR DELETE OR UPDATE OF is_seen, sender_id, support_id
+    ON messages
+    FOR ROW
+EXECUTE FUNCTION count_unread_messages();
+
+-- get_messages and /support_events read a thread in id order from a given id on
+CREATE INDEX IF NOT EXISTS messages_support_id_idx ON messages (support_id, id);
+DROP INDEX IF EXISTS messages_support_date_idx;
+-- the staff inbox of get_support_tickets
+CREATE INDEX IF NOT EXISTS support_tickets_staff_unread_idx ON support_tickets (last_message_id) WHERE staff_unread > 0;
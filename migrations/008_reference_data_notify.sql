@@ -0,0 +1,27 @@
+-- Announce every change to the reference tables on the reference_data channel, with the table's name as the
+-- payload, so that each API process reloads its in-memory copy (reference_data.py). Notifications are delivered when
+-- the transaction commits, and identical ones within a transaction are sent once.
+
+CREATE FUNCTION notify_reference_data() RETURNS trigger AS
+$notify_reference_data$
+BEGIN
+    PERFORM pg_notify('reference_data', TG_TABLE_NAME);
+    RETURN NULL;
+END;
+$notify_reference_data$ LANGUAGE plpgsql;
+
+CREATE TRIGGER notify_reference_data
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE
+    ON cities
+    FOR STATEMENT
+EXECUTE FUNCTION notify_reference_data();
+CREATE TRIGGER notify_reference_data
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE
+    ON agencies
+    FOR STATEMENT
+EXECUTE FUNCTION notify_reference_data();
+CREATE TRIGGER notify_reference_data
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE
+    ON discounts
+    FOR STATEMENT
+EXECUTE FUNCTION notify_reference_data();
@@ -0,0 +1,650 @@
+-- Partition travels and tickets by the month of the travel, so that searches for future departures and statistics
+-- for a month only read that month's partitions, and past months can be archived by detaching them. Tickets carry
+-- their travel's date to be partitioned the same way; it follows the travel through the foreign key.
+--
+-- Partitions are named travels_yYYYYmMM and tickets_yYYYYmMM. ensure_month_partitions() creates them (partitions.py
+-- keeps a year ahead of today), archive_month() moves a past month to the archive schema. The rollups of
+-- migrations/005 keep counting archived months, so top_5_customers and get_highest_income still answer for them.
+
+CREATE SCHEMA IF NOT EXISTS archive;
+
+CREATE TABLE IF NOT EXISTS archived_months
+(
+    month       date primary key,
+    travels     int       not null,
+    tickets     int       not null,
+    archived_at timestamp not null default now()
+);
+
+-- Creates the partitions of the months from first_month to last_month that don't exist yet; returns how many it
+-- created. A month that was archived can't take travels again.
+CREATE FUNCTION ensure_month_partitions(first_month date, last_month date) RETURNS int AS
+$ensure_month_partitions$
+DECLARE
+    m       date := date_trunc('month', first_month);
+    suffix  text;
+    created int  := 0;
+BEGIN
+    WHILE m <= last_month
+        LOOP
+            suffix := to_char(m, '"y"YYYY"m"MM');
+            IF to_regclass('public.travels_' || suffix) IS NULL THEN
+                -- concurrent callers create each month once
+                PERFORM pg_advisory_xact_lock(hashtext('ensure_month_partitions'));
+                IF EXISTS (SELECT FROM archived_months WHERE month = m) THEN
+                    RAISE EXCEPTION 'month % is archived', to_char(m, 'YYYY-MM');
+                END IF;
+                IF to_regclass('public.travels_' || suffix) IS NULL THEN
+                    EXECUTE format('CREATE TABLE public.%I PARTITION OF travels FOR VALUES FROM (%L) TO (%L)',
+                                   'travels_' || suffix, m, m + interval '1 month');
+                    EXECUTE format('CREATE TABLE public.%I PARTITION OF tickets FOR VALUES FROM (%L) TO (%L)',
+                                   'tickets_' || suffix, m, m + interval '1 month');
+                    created := created + 1;
+                END IF;
+            END IF;
+            m := m + interval '1 month';
+        END LOOP;
+    RETURN created;
+END;
+$ensure_month_partitions$ LANGUAGE plpgsql;
+
+-- Everything that refers to the row types or the tables is recreated below.
+DROP VIEW travels_with_remaining_seats, tickets_with_price, travel_sales_from_tickets,
+    agency_monthly_income_from_tickets, agency_destination_sales_from_tickets, user_monthly_spend_from_tickets;
+DROP FUNCTION add_ticket_to_rollups(tickets, int), add_travel_to_rollups(travels, int);
+-- a travel's key is now (id, travel_date); its row is deleted by remove_travel_from_rollups instead. Archived
+-- travels keep theirs.
+ALTER TABLE travel_sales
+    DROP CONSTRAINT travel_sales_travel_fk,
+    ADD COLUMN IF NOT EXISTS archived boolean NOT NULL DEFAULT false;
+
+ALTER TABLE tickets
+    RENAME TO tickets_unpartitioned;
+ALTER TABLE travels
+    RENAME TO travels_unpartitioned;
+ALTER SEQUENCE tickets_id_seq OWNED BY NONE;
+ALTER SEQUENCE travels_id_seq OWNED BY NONE;
+
+CREATE TABLE travels
+(
+    id               int         not null default nextval('travels_id_seq'),
+    travel_date      timestamp   not null,
+    vehicle_type     varchar(20) not null,
+    price            int         not null,
+    number_of_seats  int         not null default 0,
+    source_city      int         not null,
+    destination_city int         not null,
+    agency_id        int         not null,
+    paid_count       int         not null default 0,
+    remaining_seats  int generated always as ( number_of_seats - paid_count ) stored,
+    arrival_date     timestamp,
+    constraint positive_price check ( price >= 0 ),
+    constraint check_vehicle check ( vehicle_type in ('bus', 'train', 'airplane') ),
+    constraint check_diff check ( source_city != destination_city ),
+    constraint positive_paid_count check ( paid_count >= 0 ),
+    constraint arrival_after_departure check ( arrival_date > travel_date )
+) PARTITION BY RANGE (travel_date);
+
+CREATE TABLE tickets
+(
+    id            int         not null default nextval('tickets_id_seq'),
+    user_id       int         not null,
+    status        varchar(20) not null,
+    travel_id     int         not null,
+    rating        int,
+    discount_code varchar(30),
+    paid_price    int,
+    travel_date   timestamp   not null,
+    constraint rate_buys check ( (rating is null) or (rating is not null and status = 'paid') ),
+    constraint check_status check ( status in ('paid', 'not_paid') ),
+    constraint rate_check check ( rating is null or rating between 1 and 5)
+) PARTITION BY RANGE (travel_date);
+
+SELECT ensure_month_partitions(coalesce(min(travel_date), now())::date,
+                               greatest(max(travel_date), now() + interval '12 months')::date)
+FROM travels_unpartitioned;
+
+INSERT INTO travels(id, travel_date, vehicle_type, price, number_of_seats, source_city, destination_city, agency_id,
+                    paid_count, arrival_date)
+SELECT id, travel_date, vehicle_type, price, number_of_seats, source_city, destination_city, agency_id,
+       paid_count, arrival_date
+FROM travels_unpartitioned;
+INSERT INTO tickets(id, user_id, status, travel_id, rating, discount_code, paid_price, travel_date)
+SELECT tk.id, tk.user_id, tk.status, tk.travel_id, tk.rating, tk.discount_code, tk.paid_price, t.travel_date
+FROM tickets_unpartitioned tk
+         join travels_unpartitioned t on t.id = tk.travel_id;
+
+DROP TABLE tickets_unpartitioned, travels_unpartitioned;
+ALTER SEQUENCE tickets_id_seq OWNED BY tickets.id;
+ALTER SEQUENCE travels_id_seq OWNED BY travels.id;
+
+-- a primary key of a partitioned table has to include the partition key; ids still come from one sequence
+ALTER TABLE travels
+    ADD CONSTRAINT travels_pkey PRIMARY KEY (id, travel_date),
+    ADD CONSTRAINT check_source foreign key (source_city) references cities on delete cascade on update cascade,
+    ADD CONSTRAINT check_dest foreign key (destination_city) references cities on delete cascade on update cascade,
+    ADD CONSTRAINT agency_check foreign key (agency_id) references agencies on delete cascade on update cascade;
+CREATE INDEX travels_agency_date_idx ON travels (agency_id, travel_date);
+CREATE INDEX travels_date_id_idx ON travels (travel_date, id);
+CREATE INDEX travels_destination_idx ON travels (destination_city);
+CREATE INDEX travels_route_date_idx ON travels (source_city, destination_city, travel_date);
+
+ALTER TABLE tickets
+    ADD CONSTRAINT tickets_pkey PRIMARY KEY (id, travel_date),
+    -- a travel moved to another month takes its tickets along to that month's partition
+    ADD CONSTRAINT travel_pk foreign key (travel_id, travel_date) references travels (id, travel_date)
+        on delete cascade on update cascade,
+    ADD CONSTRAINT user_pk foreign key (user_id) references users on delete cascade on update cascade,
+    ADD CONSTRAINT discount_pk foreign key (discount_code) references discounts on delete set null on update cascade;
+CREATE INDEX tickets_discount_code_idx ON tickets (discount_code) WHERE discount_code IS NOT NULL;
+CREATE INDEX tickets_travel_status_idx ON tickets (travel_id, status) INCLUDE (paid_price, rating);
+CREATE INDEX tickets_user_id_idx ON tickets (user_id, id);
+
+-- Moving a travel to another month moves its row to another partition: PostgreSQL deletes it from the old one and
+-- inserts it into the new one, and the foreign key does the same with each of its tickets. The row triggers of the
+-- move see those deletes and inserts rather than updates, so the travel is moved in the rollups up front and the
+-- triggers skip the rows it lists in travels.moving (the travel's delete) and tickets.moving (its tickets).
+CREATE FUNCTION is_moving(setting text, travel_id int) RETURNS bool AS
+$is_moving$
+SELECT coalesce(current_setting(setting, true), '') LIKE '%,' || travel_id || ',%'
+$is_moving$ LANGUAGE sql;
+
+-- Whether a ticket insert or delete is one half of a ticket moving with its travel.
+CREATE FUNCTION is_moving_ticket(op text, tk tickets) RETURNS bool AS
+$is_moving_ticket$
+SELECT is_moving('tickets.moving', tk.travel_id)
+           AND (op = 'INSERT' OR EXISTS (SELECT FROM tickets WHERE id = tk.id AND travel_id = tk.travel_id))
+$is_moving_ticket$ LANGUAGE sql;
+
+CREATE OR REPLACE FUNCTION check_tickets_violations() RETURNS trigger AS
+$check_tickets_violations$
+BEGIN
+    IF TG_OP = 'INSERT' AND pg_trigger_depth() > 1 OR TG_OP = 'UPDATE' AND OLD.travel_date != NEW.travel_date THEN
+        -- moving with its travel, checked when it was booked
+        RETURN NEW;
+    END IF;
+    IF TG_OP = 'INSERT' THEN
+        -- the moves of earlier statements are over
+        PERFORM set_config('tickets.moving', '', true);
+    END IF;
+    IF TG_OP = 'INSERT' AND
+       (select remaining_seats FROM travels WHERE id = NEW.travel_id AND travel_date = NEW.travel_date) <= 0 THEN
+        RAISE EXCEPTION 'travel is full';
+    END IF;
+    IF new.rating is not null and NEW.travel_date > now() THEN
+        RAISE EXCEPTION 'you can not rate before travel date';
+    end if;
+    IF OLD.status = 'paid' AND OLD.discount_code != new.discount_code THEN
+        RAISE EXCEPTION 'can not change discount_code after paying';
+    end if;
+
+    RETURN NEW;
+END;
+$check_tickets_violations$ LANGUAGE plpgsql;
+CREATE TRIGGER check_remaining_seats
+    BEFORE INSERT OR UPDATE
+    ON tickets
+    FOR ROW
+EXECUTE FUNCTION check_tickets_violations();
+
+CREATE OR REPLACE FUNCTION count_paid_tickets() RETURNS trigger AS
+$count_paid_tickets$
+BEGIN
+    IF TG_OP = 'UPDATE' AND OLD.status = NEW.status AND OLD.travel_id = NEW.travel_id THEN
+        RETURN NULL;
+    END IF;
+    IF TG_OP != 'UPDATE' AND is_moving_ticket(TG_OP, CASE WHEN TG_OP = 'DELETE' THEN OLD ELSE NEW END) THEN
+        RETURN NULL;
+    END IF;
+    IF TG_OP IN ('UPDATE', 'DELETE') AND OLD.status = 'paid' THEN
+        UPDATE travels SET paid_count = paid_count - 1 WHERE id = OLD.travel_id AND travel_date = OLD.travel_date;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') AND NEW.status = 'paid' THEN
+        UPDATE travels
+        SET paid_count = paid_count + 1
+        WHERE id = NEW.travel_id
+          AND travel_date = NEW.travel_date
+          AND paid_count < number_of_seats;
+        IF NOT FOUND THEN
+            RAISE EXCEPTION 'travel is full';
+        END IF;
+    END IF;
+    RETURN NULL;
+END;
+$count_paid_tickets$ LANGUAGE plpgsql;
+CREATE TRIGGER count_paid_tickets
+    AFTER INSERT OR DELETE OR UPDATE OF status, travel_id
+    ON tickets
+    FOR ROW
+EXECUTE FUNCTION count_paid_tickets();
+
+CREATE OR REPLACE FUNCTION freeze_ticket_price() RETURNS trigger AS
+$freeze_ticket_price$
+BEGIN
+    IF TG_OP = 'INSERT' AND pg_trigger_depth() > 1 THEN
+        -- moving with its travel; keeps the price it was paid at
+        RETURN NEW;
+    END IF;
+    IF NEW.status != 'paid' THEN
+        NEW.paid_price := null;
+    ELSIF TG_OP = 'INSERT' OR OLD.status != 'paid' THEN
+        NEW.paid_price := (select discounted_price(tr.price, d.percent, d.maximum_limit)
+                           from travels tr
+                                    left join discounts d on d.code = NEW.discount_code
+                           where tr.id = NEW.travel_id
+                             and tr.travel_date = NEW.travel_date);
+    END IF;
+    RETURN NEW;
+END;
+$freeze_ticket_price$ LANGUAGE plpgsql;
+CREATE TRIGGER freeze_ticket_price
+    BEFORE INSERT OR UPDATE OF status
+    ON tickets
+    FOR ROW
+EXECUTE FUNCTION freeze_ticket_price();
+
+-- Adds (sign = 1) or removes (sign = -1) one paid ticket.
+CREATE FUNCTION add_ticket_to_rollups(tk tickets, sign int) RETURNS void AS
+$add_ticket_to_rollups$
+DECLARE
+    tr           travels%ROWTYPE;
+    travel_month date;
+BEGIN
+    SELECT * INTO tr FROM travels WHERE id = tk.travel_id AND travel_date = tk.travel_date;
+    -- tickets deleted along with their travel; remove_travel_from_rollups already took the travel out
+    IF NOT FOUND THEN
+        RETURN;
+    END IF;
+    travel_month := date_trunc('month', tr.travel_date)::date;
+    INSERT INTO travel_sales AS s (travel_id, agency_id, sales, rating_sum, rating_count)
+    VALUES (tr.id, tr.agency_id, sign * coalesce(tk.paid_price, 0), sign * coalesce(tk.rating, 0),
+            sign * (tk.rating IS NOT NULL)::int)
+    ON CONFLICT (travel_id) DO UPDATE SET sales        = s.sales + excluded.sales,
+                                          rating_sum   = s.rating_sum + excluded.rating_sum,
+                                          rating_count = s.rating_count + excluded.rating_count;
+    INSERT INTO agency_monthly_income AS s (agency_id, month, shard, income, paid_count)
+    VALUES (tr.agency_id, travel_month, tk.id % 8, sign * coalesce(tk.paid_price, 0), sign)
+    ON CONFLICT (agency_id, month, shard) DO UPDATE SET income     = s.income + excluded.income,
+                                                        paid_count = s.paid_count + excluded.paid_count;
+    INSERT INTO agency_destination_sales AS s (agency_id, destination_city, shard, paid_count)
+    VALUES (tr.agency_id, tr.destination_city, tk.id % 8, sign)
+    ON CONFLICT (agency_id, destination_city, shard) DO UPDATE SET paid_count = s.paid_count + excluded.paid_count;
+    INSERT INTO user_monthly_spend AS s (user_id, month, destination_city, spend, paid_count)
+    VALUES (tk.user_id, travel_month, tr.destination_city, sign * coalesce(tk.paid_price, 0), sign)
+    ON CONFLICT (user_id, month, destination_city) DO UPDATE SET spend      = s.spend + excluded.spend,
+                                                                 paid_count = s.paid_count + excluded.paid_count;
+END;
+$add_ticket_to_rollups$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION maintain_ticket_rollups() RETURNS trigger AS
+$maintain_ticket_rollups$
+BEGIN
+    IF TG_OP = 'UPDATE' AND OLD.status = NEW.status AND OLD.travel_id = NEW.travel_id AND OLD.user_id = NEW.user_id
+        AND OLD.paid_price IS NOT DISTINCT FROM NEW.paid_price THEN
+        -- a rating only changes the travel's rating
+        IF NEW.status = 'paid' AND OLD.rating IS DISTINCT FROM NEW.rating THEN
+            UPDATE travel_sales
+            SET rating_sum   = rating_sum - coalesce(OLD.rating, 0) + coalesce(NEW.rating, 0),
+                rating_count = rating_count - (OLD.rating IS NOT NULL)::int + (NEW.rating IS NOT NULL)::int
+            WHERE travel_id = NEW.travel_id;
+        END IF;
+        RETURN NULL;
+    END IF;
+    IF TG_OP != 'UPDATE' AND is_moving_ticket(TG_OP, CASE WHEN TG_OP = 'DELETE' THEN OLD ELSE NEW END) THEN
+        RETURN NULL;
+    END IF;
+    IF TG_OP IN ('UPDATE', 'DELETE') AND OLD.status = 'paid' THEN
+        PERFORM add_ticket_to_rollups(OLD, -1);
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') AND NEW.status = 'paid' THEN
+        PERFORM add_ticket_to_rollups(NEW, 1);
+    END IF;
+    RETURN NULL;
+END;
+$maintain_ticket_rollups$ LANGUAGE plpgsql;
+CREATE TRIGGER maintain_ticket_rollups
+    AFTER INSERT OR DELETE OR UPDATE OF status, travel_id, user_id, rating, paid_price
+    ON tickets
+    FOR ROW
+EXECUTE FUNCTION maintain_ticket_rollups();
+
+-- Adds or removes all paid tickets of a travel under its agency, month and destination. The tickets are looked up
+-- under tickets_date, by default the travel's date.
+CREATE FUNCTION add_travel_to_rollups(tr travels, sign int, tickets_date timestamp default null) RETURNS void AS
+$add_travel_to_rollups$
+BEGIN
+    INSERT INTO agency_monthly_income AS s (agency_id, month, shard, income, paid_count)
+    SELECT tr.agency_id, date_trunc('month', tr.travel_date)::date, tk.id % 8,
+           sign * coalesce(sum(tk.paid_price), 0), sign * count(*)
+    FROM tickets tk
+    WHERE tk.travel_id = tr.id
+      AND tk.travel_date = coalesce(tickets_date, tr.travel_date)
+      AND tk.status = 'paid'
+    GROUP BY tk.id % 8
+    ON CONFLICT (agency_id, month, shard) DO UPDATE SET income     = s.income + excluded.income,
+                                                        paid_count = s.paid_count + excluded.paid_count;
+    INSERT INTO agency_destination_sales AS s (agency_id, destination_city, shard, paid_count)
+    SELECT tr.agency_id, tr.destination_city, tk.id % 8, sign * count(*)
+    FROM tickets tk
+    WHERE tk.travel_id = tr.id
+      AND tk.travel_date = coalesce(tickets_date, tr.travel_date)
+      AND tk.status = 'paid'
+    GROUP BY tk.id % 8
+    ON CONFLICT (agency_id, destination_city, shard) DO UPDATE SET paid_count = s.paid_count + excluded.paid_count;
+    INSERT INTO user_monthly_spend AS s (user_id, month, destination_city, spend, paid_count)
+    SELECT tk.user_id, date_trunc('month', tr.travel_date)::date, tr.destination_city,
+           sign * coalesce(sum(tk.paid_price), 0), sign * count(*)
+    FROM tickets tk
+    WHERE tk.travel_id = tr.id
+      AND tk.travel_date = coalesce(tickets_date, tr.travel_date)
+      AND tk.status = 'paid'
+    GROUP BY tk.user_id
+    ON CONFLICT (user_id, month, destination_city) DO UPDATE SET spend      = s.spend + excluded.spend,
+                                                                 paid_count = s.paid_count + excluded.paid_count;
+END;
+$add_travel_to_rollups$ LANGUAGE plpgsql;
+
+-- Runs while the tickets are still under the old date, so the new row is added with the tickets found there.
+CREATE FUNCTION move_travel_to_month() RETURNS trigger AS
+$move_travel_to_month$
+BEGIN
+    PERFORM add_travel_to_rollups(OLD, -1);
+    PERFORM add_travel_to_rollups(NEW, 1, OLD.travel_date);
+    UPDATE travel_sales SET agency_id = NEW.agency_id WHERE travel_id = NEW.id AND agency_id != NEW.agency_id;
+    PERFORM set_config('travels.moving', coalesce(nullif(current_setting('travels.moving', true), ''), ',')
+        || NEW.id || ',', true);
+    PERFORM set_config('tickets.moving', coalesce(nullif(current_setting('tickets.moving', true), ''), ',')
+        || NEW.id || ',', true);
+    RETURN NEW;
+END;
+$move_travel_to_month$ LANGUAGE plpgsql;
+CREATE TRIGGER move_travel_to_month
+    BEFORE UPDATE OF travel_date
+    ON travels
+    FOR ROW
+    WHEN ( date_trunc('month', OLD.travel_date) != date_trunc('month', NEW.travel_date) )
+EXECUTE FUNCTION move_travel_to_month();
+
+CREATE OR REPLACE FUNCTION move_travel_in_rollups() RETURNS trigger AS
+$move_travel_in_rollups$
+BEGIN
+    PERFORM add_travel_to_rollups(OLD, -1);
+    PERFORM add_travel_to_rollups(NEW, 1);
+    UPDATE travel_sales SET agency_id = NEW.agency_id WHERE travel_id = NEW.id AND agency_id != NEW.agency_id;
+    RETURN NULL;
+END;
+$move_travel_in_rollups$ LANGUAGE plpgsql;
+-- within the month; a move to another month is move_travel_to_month's
+CREATE TRIGGER move_travel_in_rollups
+    AFTER UPDATE OF travel_date, destination_city, agency_id
+    ON travels
+    FOR ROW
+    WHEN ( date_trunc('month', OLD.travel_date) = date_trunc('month', NEW.travel_date)
+        AND (OLD.destination_city != NEW.destination_city OR OLD.agency_id != NEW.agency_id) )
+EXECUTE FUNCTION move_travel_in_rollups();
+
+-- Runs before the cascade deletes the tickets, while they can still be attributed to the travel.
+CREATE OR REPLACE FUNCTION remove_travel_from_rollups() RETURNS trigger AS
+$remove_travel_from_rollups$
+BEGIN
+    IF is_moving('travels.moving', OLD.id) THEN
+        -- the old row of a move
+        PERFORM set_config('travels.moving', replace(current_setting('travels.moving'), ',' || OLD.id || ',', ','),
+                           true);
+        RETURN OLD;
+    END IF;
+    PERFORM add_travel_to_rollups(OLD, -1);
+    DELETE FROM travel_sales WHERE travel_id = OLD.id;
+    RETURN OLD;
+END;
+$remove_travel_from_rollups$ LANGUAGE plpgsql;
+CREATE TRIGGER remove_travel_from_rollups
+    BEFORE DELETE
+    ON travels
+    FOR ROW
+EXECUTE FUNCTION remove_travel_from_rollups();
+
+CREATE OR REPLACE FUNCTION reconcile_paid_counts(fix bool default false)
+    RETURNS TABLE
+            (
+                travel_id  int,
+                paid_count int,
+                actual     int
+            )
+AS
+$reconcile_paid_counts$
+BEGIN
+    RETURN QUERY
+        SELECT t.id, t.paid_count, c.actual::int
+        FROM travels t
+                 CROSS JOIN LATERAL (select count(*) as actual
+                                     from tickets tk
+                                     where tk.travel_id = t.id
+                                       and tk.travel_date = t.travel_date
+                                       and tk.status = 'paid') c
+        WHERE t.paid_count != c.actual;
+    IF fix THEN
+        UPDATE travels t
+        SET paid_count = (select count(*)
+                          from tickets tk
+                          where tk.travel_id = t.id and tk.travel_date = t.travel_date and tk.status = 'paid')
+        WHERE t.paid_count != (select count(*)
+                               from tickets tk
+                               where tk.travel_id = t.id and tk.travel_date = t.travel_date and tk.status = 'paid');
+    END IF;
+END;
+$reconcile_paid_counts$ LANGUAGE plpgsql;
+
+-- Paid tickets report the price they were paid at; unpaid ones the price they would cost now.
+CREATE VIEW tickets_with_price AS
+SELECT t.id,
+       t.user_id,
+       t.status,
+       t.travel_id,
+       t.rating,
+       t.discount_code,
+       coalesce(t.paid_price, discounted_price(tr.price, d.percent, d.maximum_limit)) as price,
+       t.travel_date
+FROM tickets AS t
+         join travels tr on tr.id = t.travel_id and tr.travel_date = t.travel_date
+         left join discounts d on d.code = t.discount_code;
+
+CREATE VIEW travels_with_remaining_seats AS
+SELECT t.id,
+       vehicle_type,
+       source_city,
+       destination_city,
+       t.price,
+       number_of_seats,
+       travel_date,
+       t.agency_id,
+       a.name                                                 as agency_name,
+       t.remaining_seats::bigint                              as remaining_seats,
+       CASE WHEN t.paid_count > 0 THEN coalesce(s.sales, 0) END as saleing,
+       s.rating                                               as rating
+
+FROM travels AS t
+         join agencies a on a.id = t.agency_id
+         left join travel_sales s on s.travel_id = t.id;
+
+-- The rollups of the live months computed from scratch, as in migrations/005.
+CREATE VIEW travel_sales_from_tickets AS
+SELECT t.id                                                      as travel_id,
+       t.agency_id,
+       coalesce(sum(tk.paid_price), 0)                           as sales,
+       coalesce(sum(tk.rating), 0)                               as rating_sum,
+       count(tk.rating)::int                                     as rating_count
+FROM travels t
+         left join tickets tk on tk.travel_id = t.id and tk.travel_date = t.travel_date and tk.status = 'paid'
+GROUP BY t.id, t.agency_id;
+
+CREATE VIEW agency_monthly_income_from_tickets AS
+SELECT t.agency_id, date_trunc('month', t.travel_date)::date as month, (tk.id % 8)::smallint as shard,
+       coalesce(sum(tk.paid_price), 0) as income, count(*)::int as paid_count
+FROM tickets tk
+         join travels t on t.id = tk.travel_id and t.travel_date = tk.travel_date
+WHERE tk.status = 'paid'
+GROUP BY 1, 2, 3;
+
+CREATE VIEW agency_destination_sales_from_tickets AS
+SELECT t.agency_id, t.destination_city, (tk.id % 8)::smallint as shard, count(*)::int as paid_count
+FROM tickets tk
+         join travels t on t.id = tk.travel_id and t.travel_date = tk.travel_date
+WHERE tk.status = 'paid'
+GROUP BY 1, 2, 3;
+
+CREATE VIEW user_monthly_spend_from_tickets AS
+SELECT tk.user_id, date_trunc('month', t.travel_date)::date as month, t.destination_city,
+       coalesce(sum(tk.paid_price), 0) as spend, count(*)::int as paid_count
+FROM tickets tk
+         join travels t on t.id = tk.travel_id and t.travel_date = tk.travel_date
+WHERE tk.status = 'paid'
+GROUP BY 1, 2, 3;
+
+-- Archived months stay in the rollups: their rows in the monthly rollups, travel_sales rows marked archived, and
+-- their destination counts in shard -1 of agency_destination_sales. Only the live months are rebuilt.
+CREATE OR REPLACE FUNCTION rebuild_rollups() RETURNS void AS
+$rebuild_rollups$
+BEGIN
+    LOCK TABLE travel_sales, agency_monthly_income, agency_destination_sales, user_monthly_spend;
+    DELETE FROM travel_sales WHERE NOT archived;
+    DELETE FROM agency_monthly_income WHERE month NOT IN (SELECT month FROM archived_months);
+    DELETE FROM agency_destination_sales WHERE shard >= 0;
+    DELETE FROM user_monthly_spend WHERE month NOT IN (SELECT month FROM archived_months);
+    INSERT INTO travel_sales(travel_id, agency_id, sales, rating_sum, rating_count)
+    SELECT travel_id, agency_id, sales, rating_sum, rating_count
+    FROM travel_sales_from_tickets;
+    INSERT INTO agency_monthly_income(agency_id, month, shard, income, paid_count)
+    SELECT agency_id, month, shard, income, paid_count
+    FROM agency_monthly_income_from_tickets;
+    INSERT INTO agency_destination_sales(agency_id, destination_city, shard, paid_count)
+    SELECT agency_id, destination_city, shard, paid_count
+    FROM agency_destination_sales_from_tickets;
+    INSERT INTO user_monthly_spend(user_id, month, destination_city, spend, paid_count)
+    SELECT user_id, month, destination_city, spend, paid_count
+    FROM user_monthly_spend_from_tickets;
+END;
+$rebuild_rollups$ LANGUAGE plpgsql;
+
+-- Lists rollup keys of the live months whose stored totals disagree with the tickets table. Shards are summed, and
+-- keys that are missing on one side count as zero.
+CREATE OR REPLACE FUNCTION rollup_mismatches()
+    RETURNS TABLE
+            (
+                rollup text,
+                key    text,
+                stored text,
+                actual text
+            )
+AS
+$rollup_mismatches$
+SELECT 'travel_sales', coalesce(s.travel_id, a.travel_id)::text,
+       row (s.sales, s.rating_sum, s.rating_count)::text, row (a.sales, a.rating_sum, a.rating_count)::text
+FROM (SELECT * FROM travel_sales WHERE NOT archived) s
+         full join travel_sales_from_tickets a on a.travel_id = s.travel_id
+WHERE row (coalesce(s.sales, 0), coalesce(s.rating_sum, 0), coalesce(s.rating_count, 0))
+          != row (coalesce(a.sales, 0), coalesce(a.rating_sum, 0), coalesce(a.rating_count, 0))
+   OR s.agency_id != a.agency_id
+UNION ALL
+SELECT 'agency_monthly_income', row (agency_id, month)::text,
+       row (sum(s_income), sum(s_count))::text, row (sum(a_income), sum(a_count))::text
+FROM (SELECT agency_id, month, income as s_income, paid_count as s_count, 0 as a_income, 0 as a_count
+      FROM agency_monthly_income
+      WHERE month NOT IN (SELECT month FROM archived_months)
+      UNION ALL
+      SELECT agency_id, month, 0, 0, income, paid_count
+      FROM agency_monthly_income_from_tickets) x
+GROUP BY agency_id, month
+HAVING sum(s_income) != sum(a_income)
+    OR sum(s_count) != sum(a_count)
+UNION ALL
+SELECT 'agency_destination_sales', row (agency_id, destination_city)::text,
+       sum(s_count)::text, sum(a_count)::text
+FROM (SELECT agency_id, destination_city, paid_count as s_count, 0 as a_count
+      FROM agency_destination_sales
+      WHERE shard >= 0
+      UNION ALL
+      SELECT agency_id, destination_city, 0, paid_count
+      FROM agency_destination_sales_from_tickets) x
+GROUP BY agency_id, destination_city
+HAVING sum(s_count) != sum(a_count)
+UNION ALL
+SELECT 'user_monthly_spend', row (user_id, month, destination_city)::text,
+       row (sum(s_spend), sum(s_count))::text, row (sum(a_spend), sum(a_count))::text
+FROM (SELECT user_id, month, destination_city, spend as s_spend, paid_count as s_count, 0 as a_spend, 0 as a_count
+      FROM user_monthly_spend
+      WHERE month NOT IN (SELECT month FROM archived_months)
+      UNION ALL
+      SELECT user_id, month, destination_city, 0, 0, spend, paid_count
+      FROM user_monthly_spend_from_tickets) x
+GROUP BY user_id, month, destination_city
+HAVING sum(s_spend) != sum(a_spend)
+    OR sum(s_count) != sum(a_count)
+$rollup_mismatches$ LANGUAGE sql;
+
+-- Detaches a past month's partitions and moves them to the archive schema, and to tablespace if one is given. Their
+-- tickets stay counted in the rollups. The archived tables keep their rows and indexes but no foreign keys, so
+-- deleting a user or a city later doesn't reach into them. Takes an exclusive lock on travels and tickets briefly.
+CREATE FUNCTION archive_month(archived date, tablespace name default null) RETURNS void AS
+$archive_month$
+DECLARE
+    m         date := date_trunc('month', archived);
+    suffix    text := to_char(date_trunc('month', archived), '"y"YYYY"m"MM');
+    n_travels int;
+    n_tickets int;
+    tbl       text;
+    fk        name;
+    idx       regclass;
+BEGIN
+    IF m >= date_trunc('month', now()) THEN
+        RAISE EXCEPTION 'month % is not over', to_char(m, 'YYYY-MM');
+    END IF;
+    IF to_regclass('public.travels_' || suffix) IS NULL THEN
+        RAISE EXCEPTION 'month % has no partitions', to_char(m, 'YYYY-MM');
+    END IF;
+    LOCK TABLE travels, tickets, travel_sales, agency_destination_sales IN SHARE ROW EXCLUSIVE MODE;
+    EXECUTE format('SELECT count(*) FROM public.%I', 'travels_' || suffix) INTO n_travels;
+    EXECUTE format('SELECT count(*) FROM public.%I', 'tickets_' || suffix) INTO n_tickets;
+
+    UPDATE travel_sales s
+    SET archived = true
+    FROM travels t
+    WHERE t.travel_date >= m
+      AND t.travel_date < m + interval '1 month'
+      AND s.travel_id = t.id;
+    -- the only rollup that isn't by month: its counts of the month move from the live shards to shard -1
+    INSERT INTO agency_destination_sales AS s (agency_id, destination_city, shard, paid_count)
+    SELECT t.agency_id, t.destination_city, x.shard, x.sign * count(*)
+    FROM tickets tk
+             join travels t on t.id = tk.travel_id and t.travel_date = tk.travel_date
+             cross join lateral (values ((tk.id % 8)::smallint, -1), (-1::smallint, 1)) x(shard, sign)
+    WHERE tk.travel_date >= m
+      AND tk.travel_date < m + interval '1 month'
+      AND tk.status = 'paid'
+    GROUP BY 1, 2, 3, x.sign
+    ON CONFLICT (agency_id, destination_city, shard) DO UPDATE SET paid_count = s.paid_count + excluded.paid_count;
+
+    -- the tickets first: the travels can't be detached while rows of a table with a foreign key to them refer to them
+    FOREACH tbl IN ARRAY ARRAY ['tickets', 'travels']
+        LOOP
+            EXECUTE format('ALTER TABLE %I DETACH PARTITION public.%I', tbl, tbl || '_' || suffix);
+            tbl := tbl || '_' || suffix;
+            FOR fk IN SELECT conname FROM pg_constraint WHERE conrelid = ('public.' || tbl)::regclass AND contype = 'f'
+                LOOP
+                    EXECUTE format('ALTER TABLE public.%I DROP CONSTRAINT %I', tbl, fk);
+                END LOOP;
+            EXECUTE format('ALTER TABLE public.%I ALTER id DROP DEFAULT', tbl);
+            EXECUTE format('ALTER TABLE public.%I SET SCHEMA archive', tbl);
+            IF tablespace IS NOT NULL THEN
+                EXECUTE format('ALTER TABLE archive.%I SET TABLESPACE %I', tbl, tablespace);
+                FOR idx IN SELECT indexrelid FROM pg_index WHERE indrelid = ('archive.' || tbl)::regclass
+                    LOOP
+                        EXECUTE format('ALTER INDEX %s SET TABLESPACE %I', idx, tablespace);
+                    END LOOP;
+            END IF;
+        END LOOP;
+    INSERT INTO archived_months(month, travels, tickets) VALUES (m, n_travels, n_tickets);
+END;
+$archive_month$ LANGUAGE plpgsql;
+
+ANALYZE travels, tickets;
@@ -0,0 +1,118 @@
+-- A feed of changed travels for partners that mirror the schedule (change_feed.py, /travel_changes). Every write to
+-- a travel, including the seat counter updates made by the ticket triggers, records the travel in
+-- travel_changes_pending. sequence_travel_changes() then numbers the committed ones in travel_changes, in the order
+-- it finds them committed. A sequence number drawn when the write happened would follow the writes' start order,
+-- not their commit order, and a client could read past one that commits late. Readers follow travel_changes by seq
+-- and look up each changed travel's current row.
+
+CREATE TABLE IF NOT EXISTS travel_changes_pending
+(
+    id          bigint generated always as identity primary key,
+    travel_id   int         not null,
+    travel_date timestamp   not null,
+    changed_at  timestamptz not null default now()
+);
+
+-- One row per travel and sequencing run; travel_date is the travel's date when it changed, to find its partition.
+CREATE TABLE IF NOT EXISTS travel_changes
+(
+    seq         bigint generated always as identity primary key,
+    travel_id   int         not null,
+    travel_date timestamp   not null,
+    changed_at  timestamptz not null
+);
+CREATE INDEX IF NOT EXISTS travel_changes_travel_idx ON travel_changes (travel_id, seq);
+CREATE INDEX IF NOT EXISTS travel_changes_changed_at_idx ON travel_changes (changed_at);
+
+-- compacted_through: the last seq of a deleted travel that compaction removed. A client whose cursor is older may
+-- have missed that delete and has to bootstrap again.
+CREATE TABLE IF NOT EXISTS change_feed
+(
+    compacted_through bigint not null
+);
+INSERT INTO change_feed (compacted_through)
+SELECT 0
+WHERE NOT EXISTS (SELECT FROM change_feed);
+
+CREATE FUNCTION record_travel_change() RETURNS trigger AS
+$record_travel_change$
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        INSERT INTO travel_changes_pending (travel_id, travel_date) VALUES (OLD.id, OLD.travel_date);
+    ELSE
+        INSERT INTO travel_changes_pending (travel_id, travel_date) VALUES (NEW.id, NEW.travel_date);
+    END IF;
+    RETURN NULL;
+END;
+$record_travel_change$ LANGUAGE plpgsql;
+-- a move to another month is a delete from the old partition and an insert into the new one
+CREATE TRIGGER record_travel_change
+    AFTER INSERT OR DELETE
+    ON travels
+    FOR ROW
+EXECUTE FUNCTION record_travel_change();
+CREATE TRIGGER record_travel_update
+    AFTER UPDATE
+    ON travels
+    FOR ROW
+    WHEN ( OLD IS DISTINCT FROM NEW )
+EXECUTE FUNCTION record_travel_change();
+
+-- Moves up to batch committed pending changes into travel_changes, one row per travel, and returns how many it
+-- moved. Runs are serialized, and each one sees what the previous one committed, so every seq it hands out is
+-- larger than any a reader has seen. Returns 0 without waiting while another run holds the lock. Call it in a
+-- READ COMMITTED transaction of its own, so that it sees what the previous run committed.
+CREATE FUNCTION sequence_travel_changes(batch int) RETURNS int AS
+$sequence_travel_changes$
+DECLARE
+    moved int;
+BEGIN
+    IF NOT pg_try_advisory_xact_lock(hashtext('sequence_travel_changes')) THEN
+        RETURN 0;
+    END IF;
+    WITH taken AS (
+        DELETE FROM travel_changes_pending
+            WHERE id IN (SELECT id FROM travel_changes_pending ORDER BY id LIMIT batch)
+            RETURNING id, travel_id, travel_date, changed_at),
+         latest AS (SELECT DISTINCT ON (travel_id) id, travel_id, travel_date, changed_at
+                    FROM taken
+                    ORDER BY travel_id, id DESC)
+    INSERT
+    INTO travel_changes (travel_id, travel_date, changed_at)
+    SELECT travel_id, travel_date, changed_at
+    FROM latest
+    ORDER BY id;
+    GET DIAGNOSTICS moved = ROW_COUNT;
+    RETURN moved;
+END;
+$sequence_travel_changes$ LANGUAGE plpgsql;
+
+-- Drops the changes older than retention that no client needs any more: those superseded by a later change of the
+-- same travel, and the last change of a travel that was deleted or archived. A client resuming from before such a
+-- removed last change has to bootstrap again. Returns how many changes it dropped.
+CREATE FUNCTION compact_travel_changes(retention interval) RETURNS int AS
+$compact_travel_changes$
+DECLARE
+    superseded int;
+    gone       int;
+BEGIN
+    PERFORM pg_advisory_xact_lock(hashtext('sequence_travel_changes'));
+    DELETE
+    FROM travel_changes c
+    WHERE c.changed_at < now() - retention
+      AND EXISTS (SELECT FROM travel_changes l WHERE l.travel_id = c.travel_id AND l.seq > c.seq);
+    GET DIAGNOSTICS superseded = ROW_COUNT;
+    WITH removed AS (
+        DELETE FROM travel_changes c
+            WHERE c.changed_at < now() - retention
+                AND NOT EXISTS (SELECT FROM travels t WHERE t.id = c.travel_id)
+            RETURNING seq),
+         horizon AS (
+             UPDATE change_feed
+                 SET compacted_through = greatest(compacted_through, (SELECT max(seq) FROM removed)))
+    SELECT count(*)
+    INTO gone
+    FROM removed;
+    RETURN superseded + gone;
+END;
+$compact_travel_changes$ LANGUAGE plpgsql;
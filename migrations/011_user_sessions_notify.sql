@@ -0,0 +1,25 @@
+-- Announce every change to a user that a cached session depends on (deactivation, role, agency, password) and every
+-- deleted user on the user_sessions channel, with the user's id as the payload, so that every API process drops that
+-- user's cached sessions (sessions.py), whichever process or client made the change. Notifications are delivered
+-- when the transaction commits.
+
+CREATE FUNCTION notify_user_sessions() RETURNS trigger AS
+$notify_user_sessions$
+BEGIN
+    PERFORM pg_notify('user_sessions', OLD.id::text);
+    RETURN NULL;
+END;
+$notify_user_sessions$ LANGUAGE plpgsql;
+
+CREATE TRIGGER notify_user_sessions
+    AFTER UPDATE OF is_active, user_role, agency_id, password
+    ON users
+    FOR ROW
+    WHEN ( OLD.is_active IS DISTINCT FROM NEW.is_active OR OLD.user_role IS DISTINCT FROM NEW.user_role OR
+           OLD.agency_id IS DISTINCT FROM NEW.agency_id OR OLD.password IS DISTINCT FROM NEW.password )
+EXECUTE FUNCTION notify_user_sessions();
+CREATE TRIGGER notify_user_sessions_delete
+    AFTER DELETE
+    ON users
+    FOR ROW
+EXECUTE FUNCTION notify_user_sessions();
@@ -0,0 +1,30 @@
+-- Announce the route and day of every changed travel on the route_days channel, as
+-- 'source_city destination_city YYYY-MM-DD', so that every API process drops its cached searches and itinerary legs
+-- of that route and day (main.py), whichever process or client made the change. An edit announces both the old and
+-- the new route and day, and the seat counter updates made by the ticket triggers announce the travel's. Notifications
+-- are delivered when the transaction commits, and identical ones within a transaction are sent once.
+
+CREATE FUNCTION notify_route_days() RETURNS trigger AS
+$notify_route_days$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        PERFORM pg_notify('route_days', concat_ws(' ', OLD.source_city, OLD.destination_city, OLD.travel_date::date));
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        PERFORM pg_notify('route_days', concat_ws(' ', NEW.source_city, NEW.destination_city, NEW.travel_date::date));
+    END IF;
+    RETURN NULL;
+END;
+$notify_route_days$ LANGUAGE plpgsql;
+
+CREATE TRIGGER notify_route_days
+    AFTER INSERT OR DELETE
+    ON travels
+    FOR ROW
+EXECUTE FUNCTION notify_route_days();
+CREATE TRIGGER notify_route_days_update
+    AFTER UPDATE
+    ON travels
+    FOR ROW
+    WHEN ( OLD.* IS DISTINCT FROM NEW.* )
+EXECUTE FUNCTION notify_route_days();
@@ -0,0 +1,102 @@
+import asyncio
+import logging
+import os
+
+from database import connect_listener
+
+LISTEN_RETRY = float(os.environ.get('LISTEN_RETRY', 5))
+
+log = logging.getLogger('notifications')
+
+
+class Listener:
+    # One LISTEN connection per process for every channel the app follows, outside the connection pool. Handlers
+    # registered with on() get each notification's payload; coroutines registered with on_connect() run after
+    # every (re)connect, to catch up on what was announced while there was no listener. fetch() runs a query on the
+    # same connection. Runs on the event loop only.
+    def __init__(self, connect):
+        self.connect = connect
+        self.handlers = {}
+        self.connect_handlers = []
+        self.task = None
+        self.conn = None
+        self.ready = None
+        self.query_lock = None
+        self.notifications = 0
+        self.reconnects = 0
+
+    def on(self, channel, handler):
+        self.handlers.setdefault(channel, []).append(handler)
+
+    def on_connect(self, handler):
+        self.connect_handlers.append(handler)
+
+    def start(self):
+        """Start listening on the running event loop, unless already started there; returns an event set once the
+        connect handlers have run."""
+        # a new event loop (a test client, a reloaded worker) needs its own listener
+        if self.task is None or self.task.done() or self.task.get_loop() is not asyncio.get_running_loop():
+            self.ready = asyncio.Event()
+            self.query_lock = asyncio.Lock()
+            self.task = asyncio.get_running_loop().create_task(self.listen())
+        return self.ready
+
+    async def stop(self):
+        if self.task is not None and not self.task.done():
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+
+    async def fetch(self, query):
+        """The rows of query as dicts, read through the listening connection; raises if it isn't connected."""
+        # a connection runs one query at a time
+        async with self.query_lock:
+            if self.conn is None:
+                raise ConnectionError('not listening')
+            return [dict(r) for r in await self.conn.fetch(query)]
+
+    def notified(self, connection, pid, channel, payload):
+        self.notifications += 1
+        for handler in self.handlers.get(channel, ()):
+            try:
+                handler(payload)
+            except Exception as e:
+                log.error('%s handler: %s', channel, e)
+
+    async def listen(self):
+        while True:
+            conn = None
+            try:
+                conn = await self.connect()
+                lost = asyncio.get_running_loop().create_future()
+                conn.add_termination_listener(lambda c: lost.done() or lost.set_result(None))
+                for channel in self.handlers:
+                    await conn.add_listener(channel, self.notified)
+                self.conn = conn
+                for handler in self.connect_handlers:
+                    await handler()
+                self.ready.set()
+                await lost
+            except asyncio.CancelledError:
+                raise
+            except ImportError as e:
+                # asyncpg isn't installed; the caches fall back to their TTLs
+                log.warning('not listening for notifications: %s', e)
+                return
+            except Exception as e:
+                log.error('listener: %s', e)
+            finally:
+                self.conn = None
+                if conn is not None and not conn.is_closed():
+                    await conn.close()
+            self.reconnects += 1
+            await asyncio.sleep(LISTEN_RETRY)
+
+    def stats(self):
+        return {'connected': int(self.conn is not None), 'channels': len(self.handlers),
+                'notifications': self.notifications, 'reconnects': self.reconnects}
+
+
+listener = Listener(connect_listener)
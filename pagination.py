@@ -0,0 +1,116 @@
+import base64
+import json
+import os
+from datetime import date, datetime
+from decimal import Decimal
+
+from fastapi import HTTPException
+
+from columnar import Columns
+
+DEFAULT_PAGE_SIZE = int(os.environ.get('DEFAULT_PAGE_SIZE', 50))
+MAX_PAGE_SIZE = int(os.environ.get('MAX_PAGE_SIZE', 500))
+
+
+def page_size(limit):
+    if limit is None:
+        return DEFAULT_PAGE_SIZE
+    return max(1, min(limit, MAX_PAGE_SIZE))
+
+
+def _dump(value):
+    # JSON has no timestamps or decimals; tag them so the cursor binds the same type the column has
+    if isinstance(value, datetime):
+        return {'datetime': value.isoformat()}
+    if isinstance(value, date):
+        return {'date': value.isoformat()}
+    if isinstance(value, Decimal):
+        return {'decimal': str(value)}
+    return value
+
+
+def _load(value):
+    if isinstance(value, dict):
+        (kind, raw), = value.items()
+        return {'datetime': datetime.fromisoformat, 'date': date.fromisoformat, 'decimal': Decimal}[kind](raw)
+    return value
+
+
+def encode_cursor(key, value, row_id):
+    payload = json.dumps([key, _dump(value), row_id], separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor, key):
+    try:
+        cursor_key, value, row_id = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        value = _load(value)
+    except (ValueError, TypeError, KeyError, ArithmeticError):
+        raise HTTPException(status_code=400, detail='invalid cursor')
+    # a cursor only continues the ordering it was issued for
+    if cursor_key != key or type(row_id) is not int:
+        raise HTTPException(status_code=400, detail='invalid cursor')
+    return value, row_id
+
+
+class Keyset:
+    """One page of a query ordered by (sort expression, id).
+
+    The next page starts strictly after the last row's (sort value, id) instead of skipping an OFFSET, so with an
+    index on those columns every page costs the same as the first one.
+    """
+
+    def __init__(self, sort_name, sort_expr, id_expr, ascending, cursor, limit):
+        self.key = f"{sort_name}:{'asc' if ascending else 'desc'}"
+        self.sort_expr = sort_expr
+        self.id_expr = id_expr
+        self.ascending = ascending
+        self.limit = page_size(limit)
+        self.after = decode_cursor(cursor, self.key) if cursor else None
+
+    def query(self, query):
+        return query + self.where() + self.order_by()
+
+    def where(self):
+        if self.after is None:
+            return ''
+        op = '>' if self.ascending else '<'
+        if self.sort_expr == self.id_expr:
+            return f" AND {self.id_expr} {op} :after_id"
+        return f" AND ({self.sort_expr}, {self.id_expr}) {op} (:after_value, :after_id)"
+
+    def order_by(self, limit=True):
+        direction = 'asc' if self.ascending else 'desc'
+        order_by = f" ORDER BY {self.id_expr} {direction}"
+        if self.sort_expr != self.id_expr:
+            order_by = f" ORDER BY {self.sort_expr} {direction}, {self.id_expr} {direction}"
+        return order_by + (" LIMIT :page_limit" if limit else '')
+
+    def params(self):
+        after_value, after_id = self.after or (None, None)
+        # one row past the page tells whether there is a next one
+        return dict(after_value=after_value, after_id=after_id, page_limit=self.limit + 1)
+
+    def page(self, rows, sort_column='page_key', id_column='id'):
+        if rows is False:
+            return False
+        if isinstance(rows, Columns):
+            return self.page_columns(rows, sort_column, id_column)
+        items = rows[:self.limit]
+        next_cursor = None
+        if len(rows) > self.limit:
+            next_cursor = encode_cursor(self.key, items[-1][sort_column], items[-1][id_column])
+        if sort_column == 'page_key':
+            for row in items:
+                del row['page_key']
+        return {'items': items, 'next_cursor': next_cursor}
+
+    def page_columns(self, columns, sort_column, id_column):
+        next_cursor = None
+        if len(columns) > self.limit:
+            last = self.limit - 1
+            next_cursor = encode_cursor(self.key, columns.value(last, sort_column), columns.value(last, id_column))
+            columns.truncate(self.limit)
+        if sort_column == 'page_key':
+            columns.drop('page_key')
+        return {'items': columns, 'next_cursor': next_cursor}
@@ -0,0 +1,114 @@
+"""Keep travels and tickets partitioned ahead of time and archive past months
+(migrations/009_partition_travels_by_month.sql).
+
+    python partitions.py                            create the partitions of the next PARTITION_MONTHS_AHEAD months
+    python partitions.py --ahead 24                 ... of the next 24 months
+    python partitions.py --archive-after 24         also archive the months that ended over 24 months ago
+    python partitions.py --archive-after 24 --tablespace cold
+                                                    ... and move their tables to the tablespace cold
+    python partitions.py --list                     list the partitions and the archived months
+
+Run it daily, e.g. from cron. A write for a month beyond the horizon creates that month's partitions itself, but
+that locks travels and tickets exclusively for a moment while requests are being served. Archived months are moved
+to the archive schema; their tickets stay counted in the analytics rollups.
+"""
+import argparse
+import os
+import sys
+import threading
+from datetime import date
+
+from sqlalchemy import create_engine, text
+
+from database import DATABASE_URL, get_engine, record_failure
+
+PARTITION_MONTHS_AHEAD = int(os.environ.get('PARTITION_MONTHS_AHEAD', 12))
+
+ENSURE_PARTITIONS_QUERY = "SELECT ensure_month_partitions(CAST(:first AS date), CAST(:last AS date))"
+ENSURE_AHEAD_QUERY = \
+    "SELECT ensure_month_partitions(CAST(now() AS date), CAST(now() + make_interval(months => :n) AS date))"
+PARTITIONS_QUERY = \
+    "SELECT to_date(right(c.relname, 8), '\"y\"YYYY\"m\"MM') AS month, greatest(c.reltuples, 0)::bigint AS travels " \
+    "FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid WHERE i.inhparent = 'travels'::regclass ORDER BY 1"
+ARCHIVED_MONTHS_QUERY = "SELECT month, travels, tickets, archived_at FROM archived_months ORDER BY month"
+ARCHIVABLE_MONTHS_QUERY = \
+    "SELECT month FROM (" + PARTITIONS_QUERY + ") p " \
+    "WHERE month < date_trunc('month', now()) - make_interval(months => :n) ORDER BY month"
+ARCHIVE_MONTH_QUERY = "SELECT archive_month(CAST(:month AS date), :tablespace)"
+
+
+def month_of(d):
+    return date(d.year, d.month, 1)
+
+
+class MonthPartitions:
+    # The months this process has seen partitions for, so that a write checks for its month's partitions once per
+    # process rather than on every request. ensure() creates missing ones in a transaction of its own; a caller
+    # that has to create them in its own transaction (the import, which already holds locks on travels) takes
+    # missing() and remember()s them once it has committed.
+    def __init__(self):
+        self.known = set()
+        self.lock = threading.Lock()
+
+    def missing(self, dates):
+        months = {month_of(d) for d in dates if d is not None}
+        with self.lock:
+            return sorted(months - self.known)
+
+    def remember(self, months):
+        with self.lock:
+            self.known.update(months)
+
+    def ensure(self, dates):
+        """Make sure the months of dates have partitions; returns False if they couldn't be created, e.g. for an
+        archived month."""
+        months = self.missing(dates)
+        if not months:
+            return True
+        try:
+            with get_engine().begin() as conn:
+                for m in months:
+                    conn.execute(text(ENSURE_PARTITIONS_QUERY), {'first': m, 'last': m})
+        except Exception as e:
+            record_failure('ensure_partitions', e)
+            return False
+        self.remember(months)
+        return True
+
+
+month_partitions = MonthPartitions()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database-url', default=DATABASE_URL)
+    parser.add_argument('--ahead', type=int, default=PARTITION_MONTHS_AHEAD, metavar='MONTHS')
+    parser.add_argument('--archive-after', type=int, metavar='MONTHS',
+                        help='archive the months that ended more than this many months ago')
+    parser.add_argument('--tablespace', help='move archived tables to this tablespace')
+    parser.add_argument('--list', action='store_true')
+    args = parser.parse_args()
+
+    engine = create_engine(args.database_url)
+    with engine.connect() as conn:
+        if args.list:
+            for r in conn.execute(text(PARTITIONS_QUERY)):
+                print(f'{r.month:%Y-%m}  ~{r.travels} travels')
+            for r in conn.execute(text(ARCHIVED_MONTHS_QUERY)):
+                print(f'{r.month:%Y-%m}  archived {r.archived_at:%Y-%m-%d}: {r.travels} travels, {r.tickets} tickets')
+            return 0
+        created = conn.execute(text(ENSURE_AHEAD_QUERY), {'n': args.ahead}).scalar()
+        conn.commit()
+        print(f'created the partitions of {created} month(s)')
+        if args.archive_after is not None:
+            months = conn.execute(text(ARCHIVABLE_MONTHS_QUERY), {'n': args.archive_after}).scalars().all()
+            # one transaction per month: each holds exclusive locks on travels and tickets until it commits
+            for month in months:
+                conn.execute(text(ARCHIVE_MONTH_QUERY), {'month': month, 'tablespace': args.tablespace})
+                conn.commit()
+                print(f'archived {month:%Y-%m}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
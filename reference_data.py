@@ -0,0 +1,109 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+
+from city_search import city_index, CITIES_QUERY
+from notifications import listener
+
+# a safety net for when the listener is down: tables are reloaded by the next request after this many seconds
+REFERENCE_DATA_TTL = int(os.environ.get('REFERENCE_DATA_TTL', 300))
+REFERENCE_CHANNEL = 'reference_data'
+
+log = logging.getLogger('reference_data')
+
+AGENCIES_QUERY = "SELECT id, name FROM agencies ORDER BY id"
+DISCOUNTS_QUERY = "SELECT code, percent, maximum_limit FROM discounts ORDER BY code"
+
+
+class ReferenceTable:
+    # A small table held in memory by its key, e.g. agencies by id. It is invalidated by the statement triggers of
+    # migrations/008_reference_data_notify.sql through REFERENCE_CHANNEL, so every process reloads it after a
+    # change made by any of them, and reloaded by the next request after the TTL in case a notification was lost.
+    def __init__(self, key, ttl):
+        self.key = key
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.rows = None
+        self.built = -1
+        self.invalidated = -1
+        self.builds = 0
+
+    def stale(self):
+        return self.rows is None or self.invalidated >= self.built or self.built + self.ttl < time.monotonic()
+
+    def build(self, rows, started):
+        # rows were read after started; False (a failed read) keeps the old rows
+        if rows is False:
+            return
+        by_key = {r[self.key]: r for r in rows}
+        with self.lock:
+            if started > self.built:
+                self.rows, self.built = by_key, started
+                self.builds += 1
+
+    def invalidate(self):
+        with self.lock:
+            self.invalidated = time.monotonic()
+
+    def get(self, key):
+        return self.rows.get(key) if self.rows else None
+
+    def all(self):
+        return list(self.rows.values()) if self.rows else []
+
+    def stats(self):
+        with self.lock:
+            return {'rows': len(self.rows) if self.rows else 0, 'builds': self.builds,
+                    'age': round(time.monotonic() - self.built, 1) if self.rows else None, 'ttl': self.ttl}
+
+
+agencies = ReferenceTable('id', REFERENCE_DATA_TTL)
+discounts = ReferenceTable('code', REFERENCE_DATA_TTL)
+# table name -> (cache, the query that loads it); the cities are held by the city search index
+REFERENCE_TABLES = {
+    'cities': (city_index, CITIES_QUERY),
+    'agencies': (agencies, AGENCIES_QUERY),
+    'discounts': (discounts, DISCOUNTS_QUERY),
+}
+
+
+async def reload_reference_data(names=None):
+    """Reload the given tables, all by default, through the listener's connection."""
+    for name in names or REFERENCE_TABLES:
+        table, query = REFERENCE_TABLES[name]
+        started = time.monotonic()
+        rows = await listener.fetch(query)
+        # the city index takes a moment to build for a large table; keep it off the event loop
+        await asyncio.to_thread(table.build, rows, started)
+
+
+# tables with a reload waiting for the listener's connection; it reads after every change announced so far
+_queued = set()
+
+
+async def _reload(name):
+    if name in _queued:
+        return
+    _queued.add(name)
+    try:
+        async with listener.query_lock:
+            _queued.discard(name)
+        await reload_reference_data([name])
+    except Exception as e:
+        # the table stays stale and the next request that needs it reads it
+        log.error('reloading %s: %s', name, e)
+    finally:
+        _queued.discard(name)
+
+
+def _notified(payload):
+    # the payload is the name of the changed table; it is stale from now until the reload completes
+    if payload in REFERENCE_TABLES:
+        REFERENCE_TABLES[payload][0].invalidate()
+        asyncio.get_running_loop().create_task(_reload(payload))
+
+
+listener.on(REFERENCE_CHANNEL, _notified)
+listener.on_connect(reload_reference_data)
@@ -0,0 +1,39 @@
+"""Check the analytics rollups (migrations/005_analytics_rollups.sql) against the tickets they summarize.
+
+    python rollups.py              list rollup rows that differ from a recount; exits 1 if there are any
+    python rollups.py --rebuild    recompute every rollup from the tickets, then check again
+
+The triggers keep the rollups current on every write; a rebuild is only needed after writing with triggers disabled
+(bulk loads) or if the check reports drift.
+"""
+import argparse
+import sys
+
+from sqlalchemy import create_engine, text
+
+from database import DATABASE_URL
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database-url', default=DATABASE_URL)
+    parser.add_argument('--rebuild', action='store_true')
+    args = parser.parse_args()
+
+    engine = create_engine(args.database_url)
+    with engine.connect() as conn:
+        if args.rebuild:
+            conn.execute(text("SELECT rebuild_rollups()"))
+            conn.commit()
+            print('rebuilt rollups')
+        mismatches = conn.execute(text("SELECT * FROM rollup_mismatches()")).all()
+        for rollup, key, stored, actual in mismatches:
+            print(f'{rollup} {key}: stored {stored}, actual {actual}')
+        if mismatches:
+            print(f'{len(mismatches)} mismatched rollup rows')
+            return 1
+        print('rollups match the tickets')
+
+
+if __name__ == '__main__':
+    sys.exit(main())
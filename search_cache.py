@@ -0,0 +1,82 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+SEARCH_CACHE_TTL = int(os.environ.get('SEARCH_CACHE_TTL', 30))
+SEARCH_CACHE_SIZE = int(os.environ.get('SEARCH_CACHE_SIZE', 10000))
+# the route and day of every changed travel is announced here (migrations/012_route_days_notify.sql)
+ROUTE_DAYS_CHANNEL = 'route_days'
+
+
+def route_day(source_city, destination_city, travel_date):
+    return source_city, destination_city, travel_date.date()
+
+
+class SearchCache:
+    # Results of the route and day search, one entry per (source_city, destination_city, day) holding every page
+    # requested for it. Writes drop the entries of the route and day they touched, in every process.
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        # when each key was last invalidated, so a read that started before a write can't cache what it read
+        self.invalidated = OrderedDict()
+        self.cleared = -1
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key, page):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                del self.entries[key]
+                entry = None
+            if entry is None or page not in entry[1]:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1][page]
+
+    def put(self, key, page, result, started):
+        with self.lock:
+            if max(self.invalidated.get(key, -1), self.cleared) >= started:
+                return
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                entry = self.entries[key] = (started + self.ttl, {})
+            entry[1][page] = result
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        now = time.monotonic()
+        with self.lock:
+            self.invalidations += 1
+            self.entries.pop(key, None)
+            self.invalidated[key] = now
+            self.invalidated.move_to_end(key)
+            # reads that started more than a TTL ago wouldn't be cached for long anyway
+            while self.invalidated and next(iter(self.invalidated.values())) < now - self.ttl:
+                self.invalidated.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.invalidations += 1
+            self.entries.clear()
+            self.invalidated.clear()
+            self.cleared = time.monotonic()
+
+    def stats(self):
+        with self.lock:
+            return {'size': len(self.entries), 'max_size': self.max_size, 'ttl': self.ttl, 'hits': self.hits,
+                    'misses': self.misses, 'evictions': self.evictions, 'invalidations': self.invalidations}
+
+
+search_cache = SearchCache(SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL)
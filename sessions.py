@@ -0,0 +1,137 @@
+import base64
+import hashlib
+import hmac
+import os
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+from notifications import listener
+
+SESSION_SECRET = os.environ.get('SESSION_SECRET', '').encode() or secrets.token_bytes(32)
+SESSION_TTL = int(os.environ.get('SESSION_TTL', 3600))
+SESSION_CACHE_TTL = int(os.environ.get('SESSION_CACHE_TTL', 300))
+SESSION_CACHE_SIZE = int(os.environ.get('SESSION_CACHE_SIZE', 10000))
+SESSION_CHANNEL = 'user_sessions'
+
+
+def _sign(payload):
+    digest = hmac.new(SESSION_SECRET, payload.encode(), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest).decode().rstrip('=')
+
+
+def password_fingerprint(password_hash):
+    # ties a token to the stored password, so changing the password revokes it
+    return hmac.new(SESSION_SECRET, password_hash.encode(), hashlib.sha256).hexdigest()[:16]
+
+
+def issue_token(user):
+    expires = int(time.time()) + SESSION_TTL
+    payload = f"{user['id']}.{expires}.{password_fingerprint(user['password'])}"
+    return payload + '.' + _sign(payload), expires
+
+
+def verify_token(token):
+    try:
+        user_id, expires, fingerprint, signature = token.split('.')
+        if not hmac.compare_digest(signature, _sign(f'{user_id}.{expires}.{fingerprint}')):
+            return None
+        if int(expires) < time.time():
+            return None
+        return {'id': int(user_id), 'expires': int(expires), 'fingerprint': fingerprint}
+    except (ValueError, TypeError):
+        # TypeError: compare_digest refuses non-ASCII strings
+        return None
+
+
+class SessionCache:
+    # The users behind recently used tokens. A change to a user made by any process drops the user's sessions in
+    # every process: the triggers of migrations/011_user_sessions_notify.sql announce it on SESSION_CHANNEL. While the
+    # listener is down, other processes keep a changed user's sessions for up to ttl seconds; they drop all of them
+    # once it has reconnected.
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.tokens_by_user = {}
+        # user id -> when the user's sessions were last dropped, kept for ttl seconds
+        self.invalidated = {}
+        self.cleared = -1
+        self.invalidations = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, token):
+        with self.lock:
+            entry = self.entries.get(token)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    self._remove(token)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(token)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, token, user, expires, read_at=None):
+        # read_at: when the user row was read; a row read before the user's sessions were dropped isn't cached
+        session = {'id': user['id'], 'user_role': user['user_role'], 'agency_id': user['agency_id']}
+        ttl = min(self.ttl, expires - time.time())
+        with self.lock:
+            if read_at is not None and read_at <= max(self.cleared, self.invalidated.get(session['id'], -1)):
+                return session
+            if token in self.entries:
+                self._remove(token)
+            self.entries[token] = (time.monotonic() + ttl, session)
+            self.tokens_by_user.setdefault(session['id'], set()).add(token)
+            while len(self.entries) > self.max_size:
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+        return session
+
+    def invalidate_user(self, user_id):
+        now = time.monotonic()
+        with self.lock:
+            for token in list(self.tokens_by_user.get(user_id, ())):
+                self._remove(token)
+            self.invalidated = {u: at for u, at in self.invalidated.items() if at + self.ttl > now}
+            self.invalidated[user_id] = now
+            self.invalidations += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.tokens_by_user.clear()
+            self.cleared = time.monotonic()
+
+    def _remove(self, token):
+        _, session = self.entries.pop(token)
+        tokens = self.tokens_by_user.get(session['id'])
+        if tokens is not None:
+            tokens.discard(token)
+            if not tokens:
+                del self.tokens_by_user[session['id']]
+
+    def stats(self):
+        with self.lock:
+            return {'size': len(self.entries), 'max_size': self.max_size, 'hits': self.hits,
+                    'misses': self.misses, 'evictions': self.evictions, 'invalidations': self.invalidations}
+
+
+session_cache = SessionCache(SESSION_CACHE_SIZE, SESSION_CACHE_TTL)
+
+
+def _notified(payload):
+    session_cache.invalidate_user(int(payload))
+
+
+async def _reconnected():
+    # users changed while there was no listener were never announced
+    session_cache.clear()
+
+
+listener.on(SESSION_CHANNEL, _notified)
+listener.on_connect(_reconnected)
@@ -0,0 +1,86 @@
+import asyncio
+import json
+import os
+import time
+
+from fastapi.encoders import jsonable_encoder
+
+from notifications import listener
+
+SUPPORT_CHANNEL = 'support_messages'
+# seconds between the comments that keep an idle /support_events stream open through proxies
+SUPPORT_KEEPALIVE = float(os.environ.get('SUPPORT_KEEPALIVE', 15))
+# a stream is closed after this many seconds and the client reconnects with Last-Event-ID, so that its token is
+# checked again
+SUPPORT_STREAM_SECONDS = float(os.environ.get('SUPPORT_STREAM_SECONDS', 600))
+
+
+class SupportStreams:
+    # The open /support_events streams by thread. send_messages notifies SUPPORT_CHANNEL with the thread and message
+    # id (migrations/007_support_unread.sql) and the shared listener wakes the streams of that thread, which then
+    # read the messages after the last one they sent. Waking rather than passing the message on means a burst of
+    # messages costs each stream one read, and a stream that missed notifications while the listener reconnected
+    # catches up on the next wake-up. Runs on the event loop only.
+    def __init__(self):
+        self.subscribers = {}
+        listener.on(SUPPORT_CHANNEL, self.notified)
+        listener.on_connect(self.wake_all)
+
+    def subscribe(self, support_id):
+        listener.start()
+        wake = asyncio.Event()
+        self.subscribers.setdefault(support_id, set()).add(wake)
+        return wake
+
+    def unsubscribe(self, support_id, wake):
+        streams = self.subscribers.get(support_id)
+        if streams is not None:
+            streams.discard(wake)
+            if not streams:
+                del self.subscribers[support_id]
+
+    def notified(self, payload):
+        support_id = int(payload.split(' ', 1)[0])
+        for wake in self.subscribers.get(support_id, ()):
+            wake.set()
+
+    async def wake_all(self):
+        # messages sent while there was no listener were never announced
+        for streams in self.subscribers.values():
+            for wake in streams:
+                wake.set()
+
+    def stats(self):
+        # called from the /metrics worker thread while the event loop may change subscribers
+        streams = list(self.subscribers.values())
+        return {'threads': len(streams), 'streams': sum(len(s) for s in streams)}
+
+
+support_streams = SupportStreams()
+
+
+async def event_stream(support_id, after_id, read):
+    """Server-sent events for one support thread: every message after after_id as it arrives. read(after_id) returns
+    the thread's messages after that id in id order, or False if the read failed."""
+    wake = support_streams.subscribe(support_id)
+    closes = time.monotonic() + SUPPORT_STREAM_SECONDS
+    try:
+        pending = True
+        while True:
+            if pending:
+                for m in await read(after_id) or ():
+                    after_id = m['id']
+                    yield f"id: {m['id']}\nevent: message\ndata: {json.dumps(jsonable_encoder(m))}\n\n"
+            remaining = closes - time.monotonic()
+            if remaining <= 0:
+                return
+            try:
+                await asyncio.wait_for(wake.wait(), min(SUPPORT_KEEPALIVE, remaining))
+                # cleared before the read, so a message committed during it wakes the stream again
+                wake.clear()
+                pending = True
+            except asyncio.TimeoutError:
+                pending = False
+                yield ': keepalive\n\n'
+    finally:
+        support_streams.unsubscribe(support_id, wake)